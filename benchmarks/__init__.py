@@ -0,0 +1,23 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+
+Benchmarks for odt2epub, run from the repository root:
+
+    python -m benchmarks --paragraphs 20000 --output results.json
+    python -m benchmarks --compare results.json --threshold 1.10 --threshold parse_odt=1.25
+'''
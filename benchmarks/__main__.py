@@ -0,0 +1,166 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+
+Time each conversion stage on a synthetic corpus, write the results as JSON
+and compare them against a previous run.
+'''
+from argparse import ArgumentParser
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus
+from odt2epub import imagesize
+from odt2epub.odtparser import OdtParser
+from odt2epub.txtparser import TxtParser
+from odt2epub.generator.htmlgenerator import HTMLGenerator
+from odt2epub.generator.stylesheetgenerator import StylesheetGenerator
+from odt2epub.generator.epubwriter import EpubWriter
+
+DEFAULT_THRESHOLD = 1.10
+
+
+def measure(function, repeat):
+    '''Run function repeat times, return its last result and the timings'''
+    walls = []
+    cpus = []
+    result = None
+    for __ in range(repeat):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = function()
+        cpus.append(time.process_time() - cpu)
+        walls.append(time.perf_counter() - wall)
+    return result, {'wall': min(walls), 'cpu': min(cpus), 'walls': walls}
+
+
+def run(paragraphs, repeat, images):
+    stages = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        odtfilename = os.path.join(workdir, 'book.odt')
+        txtfilename = os.path.join(workdir, 'book.txt')
+        epubfilename = os.path.join(workdir, 'book.epub')
+        corpus.make_odt(odtfilename, paragraphs)
+        corpus.make_txt(txtfilename, paragraphs)
+        imagefilenames = corpus.make_images(workdir, images)
+
+        document, stages['parse_odt'] = measure(lambda: OdtParser().parse(odtfilename), repeat)
+        __, stages['parse_odt_expat'] = measure(lambda: OdtParser(backend='expat').parse(odtfilename), repeat)
+        __, stages['parse_txt'] = measure(lambda: TxtParser().parse(txtfilename), repeat)
+
+        generator = HTMLGenerator(document, flat_html=False)
+        __, stages['get_html'] = measure(lambda: generator.get_html('../Styles/stylesheet.css'), repeat)
+        cssclasses = generator.cssclass_to_export
+        __, stages['first_page_lazy'] = measure(lambda: _first_page(OdtParser().parse_lazy(odtfilename)), repeat)
+        __, stages['stylesheet'] = measure(lambda: StylesheetGenerator(document, cssclasses, 0).get_stylesheet(), repeat)
+
+        __, stages['epub_write'] = measure(lambda: EpubWriter(document).write(epubfilename), repeat)
+
+        __, stages['imagesize'] = measure(lambda: [imagesize.get(filename) for filename in imagefilenames], repeat)
+
+        stages['parse_odt']['bytes'] = os.path.getsize(odtfilename)
+        stages['epub_write']['bytes'] = os.path.getsize(epubfilename)
+        stages['imagesize']['count'] = len(imagefilenames)
+
+    return {'meta': {'paragraphs': paragraphs,
+                     'repeat': repeat,
+                     'commit': _commit(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'stages': stages}
+
+
+def _first_page(document):
+    pages = HTMLGenerator(document, flat_html=False).iter_pages('../Styles/stylesheet.css')
+    page = next(pages)
+    pages.close()
+    document.close()
+    return page
+
+
+def compare(results, baseline, thresholds):
+    '''Print the ratio to the baseline of every stage, return the regressed ones'''
+    regressions = []
+    width = max([len('stage')] + [len(stage) for stage in results['stages']])
+    print(f'{"stage":<{width}} {"baseline":>10} {"current":>10} {"ratio":>7}')
+    for stage, timing in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        before = baseline['stages'][stage]['wall']
+        ratio = timing['wall'] / before if before else 1.0
+        threshold = thresholds.get(stage, thresholds[None])
+        flag = ''
+        if ratio > threshold:
+            regressions.append(stage)
+            flag = f'  REGRESSION (> {threshold:.2f})'
+        print(f'{stage:<{width}} {before:>10.4f} {timing["wall"]:>10.4f} {ratio:>7.2f}{flag}')
+    return regressions
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_thresholds(values):
+    thresholds = {None: DEFAULT_THRESHOLD}
+    for value in values:
+        stage, __, ratio = value.rpartition('=')
+        thresholds[stage or None] = float(ratio)
+    return thresholds
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m benchmarks', description='odt2epub stage benchmarks')
+    parser.add_argument('--paragraphs', type=int, default=20000, help='size of the synthetic odt [default: %(default)s]')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best is kept [default: %(default)s]')
+    parser.add_argument('--images', type=int, default=250, help='images per format for imagesize [default: %(default)s]')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with the results of a previous run')
+    parser.add_argument('--threshold', action='append', default=[], metavar='[STAGE=]RATIO',
+                        help=f'maximum slowdown ratio, for all stages or a single one [default: {DEFAULT_THRESHOLD}]')
+    args = parser.parse_args(argv)
+
+    results = run(args.paragraphs, args.repeat, args.images)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fout:
+            json.dump(results, fout, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as fin:
+            baseline = json.load(fin)
+        if compare(results, baseline, _parse_thresholds(args.threshold)):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+
+Time HTMLGenerator.get_html on single-chapter documents of growing size.
+With linear assembly the time per paragraph stays roughly constant.
+
+    python -m benchmarks.bench_htmlgenerator [max paragraphs]
+'''
+import sys
+import time
+
+from odt2epub.contenthandler import Paragraph
+from odt2epub.document import Document
+from odt2epub.generator.htmlgenerator import HTMLGenerator
+from odt2epub.stylehandler import Style
+
+
+def make_document(nparagraphs):
+    document = Document('benchmark')
+    body = Style({'style:name': 'Text body'}, None, False)
+    bold = Style({'style:name': 'T1', 'fo:font-weight': 'bold'}, None, True)
+    document.add_style(body)
+    document.add_style(bold)
+
+    for i in range(nparagraphs):
+        paragraph = Paragraph(body, None)
+        paragraph.append('str', f'Lorem ipsum dolor sit amet {i}, ')
+        paragraph.append('str', 'consectetur adipiscing', bold)
+        paragraph.append('str', ' elit, sed do eiusmod tempor incididunt.')
+        document.paragraps.append(paragraph)
+
+    return document
+
+
+def bench(nparagraphs, repeat=3):
+    document = make_document(nparagraphs)
+    generator = HTMLGenerator(document, flat_html=True)
+    best = None
+    for __ in range(repeat):
+        start = time.perf_counter()
+        generator.get_html('stylesheet.css')
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(maxparagraphs=128000):
+    print(f'{"paragraphs":>12} {"seconds":>10} {"us/paragraph":>14}')
+    nparagraphs = 1000
+    while nparagraphs <= maxparagraphs:
+        elapsed = bench(nparagraphs)
+        print(f'{nparagraphs:>12} {elapsed:>10.4f} {elapsed / nparagraphs * 1e6:>14.2f}')
+        nparagraphs *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,109 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+
+Time imagesize.get and getDPI on synthetic JPEG, PNG, GIF and TIFF images
+read from files, from memory and from the members of a zip file, against
+another version of imagesize.py. The headers are followed by --payload KB
+of incompressible bytes, standing for the pixel data:
+
+    git show <commit>:odt2epub/imagesize.py > /tmp/imagesize_baseline.py
+    python -m benchmarks.bench_imagesize --baseline /tmp/imagesize_baseline.py
+'''
+import argparse
+import importlib.util
+import io
+import os
+import random
+import tempfile
+import time
+import zipfile
+
+from benchmarks import corpus
+from odt2epub import imagesize
+
+
+def load_baseline(filename):
+    spec = importlib.util.spec_from_file_location('imagesize_baseline', filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench(function, repeat):
+    best = None
+    for __ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def cases(module, filenames, contents, zipfilename, current):
+    '''(name, function) probing every image once, in the ways module supports'''
+    def from_zip(function):
+        with zipfile.ZipFile(zipfilename) as zfile:
+            for name in zfile.namelist():
+                with zfile.open(name) as stream:
+                    # Older versions only take io.BytesIO
+                    function(stream if current else io.BytesIO(stream.read()))
+
+    return (('get path', lambda: [module.get(filename) for filename in filenames]),
+            ('get memory', lambda: [module.get(data if current else io.BytesIO(data)) for data in contents]),
+            ('get zip', lambda: from_zip(module.get)),
+            ('getDPI path', lambda: [module.getDPI(filename) for filename in filenames]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark odt2epub.imagesize')
+    parser.add_argument('--baseline', help='imagesize.py to compare with')
+    parser.add_argument('--images', type=int, default=500, help='images per format [default: %(default)s]')
+    parser.add_argument('--payload', type=int, default=100, help='KB of pixel data after the headers [default: %(default)s]')
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat runs [default: %(default)s]')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline) if args.baseline else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        filenames = corpus.make_images(workdir, args.images)
+        payload = random.Random(0).randbytes(args.payload * 1024)
+        contents = []
+        zipfilename = os.path.join(workdir, 'images.zip')
+        with zipfile.ZipFile(zipfilename, 'w', zipfile.ZIP_DEFLATED) as zfile:
+            for filename in filenames:
+                with open(filename, 'ab') as fout:
+                    fout.write(payload)
+                with open(filename, 'rb') as fin:
+                    contents.append(fin.read())
+                zfile.write(filename, os.path.basename(filename))
+
+        print(f'{len(filenames)} images')
+        print(f'{"case":>12} {"current":>10} {"baseline":>10} {"speedup":>8}')
+        current_cases = cases(imagesize, filenames, contents, zipfilename, True)
+        baseline_cases = cases(baseline, filenames, contents, zipfilename, False) if baseline else [(None, None)] * len(current_cases)
+        for (name, function), (__, baseline_function) in zip(current_cases, baseline_cases):
+            elapsed = bench(function, args.repeat)
+            if baseline_function:
+                baseline_elapsed = bench(baseline_function, args.repeat)
+                print(f'{name:>12} {elapsed:>10.4f} {baseline_elapsed:>10.4f} {baseline_elapsed / elapsed:>8.2f}')
+            else:
+                print(f'{name:>12} {elapsed:>10.4f}')
+
+
+if __name__ == '__main__':
+    main()
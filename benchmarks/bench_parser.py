@@ -0,0 +1,57 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+
+Time OdtParser with the SAX and the expat backends on synthetic odt files
+of growing size.
+
+    python -m benchmarks.bench_parser [max paragraphs]
+'''
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus
+from odt2epub.odtparser import OdtParser
+
+
+def bench(odtfilename, backend, repeat=3):
+    best = None
+    for __ in range(repeat):
+        start = time.perf_counter()
+        OdtParser(backend=backend).parse(odtfilename)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(maxparagraphs=64000):
+    print(f'{"paragraphs":>12} {"sax":>10} {"expat":>10} {"speedup":>8}')
+    nparagraphs = 1000
+    with tempfile.TemporaryDirectory() as workdir:
+        while nparagraphs <= maxparagraphs:
+            odtfilename = os.path.join(workdir, f'book{nparagraphs}.odt')
+            corpus.make_odt(odtfilename, nparagraphs)
+            sax = bench(odtfilename, 'sax')
+            expat = bench(odtfilename, 'expat')
+            print(f'{nparagraphs:>12} {sax:>10.4f} {expat:>10.4f} {sax / expat:>8.2f}')
+            nparagraphs *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
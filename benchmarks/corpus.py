@@ -0,0 +1,230 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+
+Synthetic corpus: odt files with paragraphs, headings, notes, nested lists,
+pagebreaks, automatic styles and images, txt files and image headers.
+'''
+import os
+import random
+import struct
+import zipfile
+import zlib
+
+NAMESPACES = ('xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+              'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+              'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+              'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" '
+              'xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0" '
+              'xmlns:svg="urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0" '
+              'xmlns:xlink="http://www.w3.org/1999/xlink"')
+
+STYLES_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<office:document-styles %(namespaces)s office:version="1.2">
+<office:styles>
+<style:style style:name="Standard" style:family="paragraph"/>
+<style:style style:name="Text_20_body" style:display-name="Text body" style:family="paragraph" style:parent-style-name="Standard"><style:paragraph-properties fo:text-align="justify"/></style:style>
+<style:style style:name="Quotations" style:family="paragraph" style:parent-style-name="Text_20_body"><style:paragraph-properties fo:text-align="end"/><style:text-properties fo:font-style="italic"/></style:style>
+<style:style style:name="Heading_20_1" style:display-name="Heading 1" style:family="paragraph" style:parent-style-name="Standard"><style:text-properties fo:font-weight="bold"/></style:style>
+<style:style style:name="Heading_20_2" style:display-name="Heading 2" style:family="paragraph" style:parent-style-name="Standard"/>
+<style:style style:name="Footnote" style:family="paragraph" style:parent-style-name="Standard"/>
+<style:style style:name="Emphasis" style:family="text"><style:text-properties fo:font-style="italic"/></style:style>
+</office:styles>
+</office:document-styles>
+'''
+
+CONTENT_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<office:document-content %(namespaces)s office:version="1.2">
+<office:automatic-styles>
+%(styles)s
+</office:automatic-styles>
+<office:body>
+<office:text>
+%(body)s
+</office:text>
+</office:body>
+</office:document-content>
+'''
+
+MANIFEST_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">
+ <manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.text"/>
+ <manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>
+ <manifest:file-entry manifest:full-path="styles.xml" manifest:media-type="text/xml"/>
+%(pictures)s</manifest:manifest>
+'''
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua ut enim ad minim veniam').split()
+
+
+def make_odt(filename, paragraphs, chapter_every=50, automatic_styles=200, images=10, seed=0):
+    '''Write a synthetic odt with about `paragraphs` blocks.
+
+    Some paragraphs show one of `images` pictures, a byte for byte copy of
+    the first one stored under another name, or a picture missing from the
+    odt.
+    '''
+    rnd = random.Random(seed)
+    pictures = _pictures(images)
+    hrefs = list(pictures) + ['Pictures/missing.png'] if pictures else []
+
+    styles = ['<style:style style:name="PB" style:family="paragraph" style:parent-style-name="Heading_20_1">'
+              '<style:paragraph-properties fo:break-before="page"/></style:style>']
+    for idx in range(1, automatic_styles + 1):
+        parent = rnd.choice(('Text_20_body', 'Quotations', 'Standard'))
+        weight = rnd.choice(('bold', 'normal'))
+        styles.append(f'<style:style style:name="P{idx}" style:family="paragraph" style:parent-style-name="{parent}">'
+                      f'<style:text-properties fo:font-weight="{weight}"/></style:style>')
+    styles.append('<style:style style:name="T1" style:family="text"><style:text-properties fo:font-weight="bold"/></style:style>')
+    styles.append('<style:style style:name="T2" style:family="text"><style:text-properties fo:font-style="italic"/></style:style>')
+    # List styles last, as LibreOffice writes them
+    styles.append('<text:list-style style:name="L1"><text:list-level-style-number text:level="1"/></text:list-style>')
+    styles.append('<text:list-style style:name="L2"><text:list-level-style-bullet text:level="1"/></text:list-style>')
+
+    body = []
+    notes = 0
+    for idx in range(paragraphs):
+        if idx % chapter_every == 0:
+            body.append(f'<text:h text:style-name="PB" text:outline-level="1">Chapter {idx // chapter_every + 1}</text:h>')
+        elif idx % 17 == 0:
+            body.append(f'<text:h text:style-name="Heading_20_2" text:outline-level="2">Section {idx}</text:h>')
+        elif idx % 23 == 0:
+            body.append(_list(rnd, idx, nested=idx % 2 == 0, heading=idx % 3 == 0))
+        else:
+            note = ''
+            if idx % 7 == 0:
+                notes += 1
+                note = (f'<text:note text:id="ftn{notes}" text:note-class="footnote">'
+                        f'<text:note-citation>{notes}</text:note-citation><text:note-body>'
+                        f'<text:p text:style-name="Footnote">{_sentence(rnd)}</text:p></text:note-body></text:note>')
+            frame = ''
+            if hrefs and idx % 11 == 0:
+                frame = _frame(idx, hrefs[idx // 11 % len(hrefs)])
+            stylename = rnd.choice(('Text_20_body', 'Quotations', f'P{rnd.randint(1, automatic_styles)}'))
+            body.append(f'<text:p text:style-name="{stylename}">{frame}{_sentence(rnd)} '
+                        f'<text:span text:style-name="T1">{_sentence(rnd)}</text:span>{note} '
+                        f'<text:span text:style-name="T2">{_sentence(rnd)}</text:span><text:line-break/>'
+                        f'{_sentence(rnd)} &amp; {_sentence(rnd)}</text:p>')
+
+    with zipfile.ZipFile(filename, 'w') as odtfile:
+        odtfile.writestr('mimetype', 'application/vnd.oasis.opendocument.text')
+        entries = ''.join(f' <manifest:file-entry manifest:full-path="{name}" manifest:media-type="{_MEDIA_TYPES[name[-3:]]}"/>\n'
+                          for name in pictures)
+        odtfile.writestr('META-INF/manifest.xml', MANIFEST_XML % {'pictures': entries}, zipfile.ZIP_DEFLATED)
+        odtfile.writestr('styles.xml', STYLES_XML % {'namespaces': NAMESPACES}, zipfile.ZIP_DEFLATED)
+        odtfile.writestr('content.xml', CONTENT_XML % {'namespaces': NAMESPACES,
+                                                       'styles': ''.join(styles),
+                                                       'body': ''.join(body)}, zipfile.ZIP_DEFLATED)
+        for name, data in pictures.items():
+            # Stored, as LibreOffice does for already compressed formats
+            odtfile.writestr(name, data)
+
+
+_MEDIA_TYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif'}
+
+
+def _pictures(count):
+    '''Pictures/ member name -> content, plus a copy of the first one'''
+    pictures = {}
+    makers = (('jpg', make_jpeg), ('png', make_png), ('gif', make_gif))
+    for idx in range(count):
+        ext, maker = makers[idx % len(makers)]
+        pictures[f'Pictures/image{idx:03}.{ext}'] = maker(640 + idx, 480 + idx)
+    if pictures:
+        name, data = next(iter(pictures.items()))
+        pictures[name.replace('image', 'copy')] = data
+    return pictures
+
+
+def _frame(idx, href):
+    return (f'<draw:frame draw:name="Image{idx}" text:anchor-type="as-char" svg:width="4cm" svg:height="3cm">'
+            f'<draw:image xlink:href="{href}" xlink:type="simple" xlink:show="embed" xlink:actuate="onLoad"/></draw:frame>')
+
+
+def _sentence(rnd, words=8):
+    return ' '.join(rnd.choice(WORDS) for __ in range(words))
+
+
+def _list(rnd, idx, nested, heading=False):
+    items = []
+    if heading:
+        # Numbered headings are list items, as LibreOffice writes them
+        items.append('<text:list-item><text:h text:style-name="Heading_20_2" text:outline-level="2">'
+                     f'Numbered {idx}</text:h></text:list-item>')
+    for item in range(3):
+        sublist = ''
+        if nested and item == 1:
+            sublist = ('<text:list text:style-name="L2"><text:list-item>'
+                       f'<text:p text:style-name="Text_20_body">{_sentence(rnd)}</text:p>'
+                       '</text:list-item></text:list>')
+        items.append(f'<text:list-item><text:p text:style-name="Text_20_body">{_sentence(rnd)}</text:p>{sublist}</text:list-item>')
+    return f'<text:list text:style-name="L{1 + idx % 2}">{"".join(items)}</text:list>'
+
+
+def make_txt(filename, paragraphs, seed=0):
+    rnd = random.Random(seed)
+    with open(filename, 'w', encoding='utf-8') as fout:
+        for __ in range(paragraphs):
+            fout.write(_sentence(rnd, 12) + '\n')
+            fout.write(_sentence(rnd, 12) + '\n\n')
+
+
+def make_jpeg(width, height, segments=20, segment_size=4096):
+    '''JPEG headers only: APPn segments to walk through, then a SOF0 marker'''
+    data = [b'\xff\xd8',
+            b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x01\x00\x48\x00\x48\x00\x00']
+    for __ in range(segments):
+        data.append(b'\xff\xe1' + struct.pack('>H', segment_size + 2) + b'\x00' * segment_size)
+    data.append(b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, height, width, 3) + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01')
+    data.append(b'\xff\xd9')
+    return b''.join(data)
+
+
+def make_png(width, height):
+    ihdr = struct.pack('>LLBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', ihdr)
+            + _png_chunk(b'pHYs', struct.pack('>LLB', 11811, 11811, 1))
+            + _png_chunk(b'IDAT', zlib.compress(b'\x00' * 64)) + _png_chunk(b'IEND', b''))
+
+
+def _png_chunk(typ, data):
+    return struct.pack('>L', len(data)) + typ + data + struct.pack('>L', zlib.crc32(typ + data))
+
+
+def make_gif(width, height):
+    return b'GIF89a' + struct.pack('<HH', width, height) + b'\x00\x00\x00;'
+
+
+def make_tiff(width, height):
+    entries = [(256, 4, 1, width), (257, 4, 1, height)]
+    ifd = struct.pack('<H', len(entries)) + b''.join(struct.pack('<HHLL', *entry) for entry in entries) + b'\x00' * 4
+    return b'II*\x00' + struct.pack('<L', 8) + ifd
+
+
+def make_images(directory, count=25):
+    '''Write count images of each supported format, return their filenames'''
+
+    filenames = []
+    makers = (('jpg', make_jpeg), ('png', make_png), ('gif', make_gif), ('tif', make_tiff))
+    for idx in range(count):
+        for ext, maker in makers:
+            filename = os.path.join(directory, f'image{idx:03}.{ext}')
+            with open(filename, 'wb') as fout:
+                fout.write(maker(640 + idx, 480 + idx))
+            filenames.append(filename)
+    return filenames
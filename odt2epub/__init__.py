@@ -19,9 +19,13 @@ Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
 from argparse import ArgumentParser, Action, SUPPRESS, ArgumentTypeError
 from argparse import FileType
 from argparse import RawDescriptionHelpFormatter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import json
 import os
 import sys
 import shutil
+import traceback
 
 try:
     from gettext import gettext as _gt, ngettext
@@ -36,16 +40,23 @@ except ImportError:
         else:
             return plural
 
-from odt2epub.odtparser import OdtParser
+from odt2epub.odtparser import OdtParser, BACKENDS
 from odt2epub.txtparser import TxtParser
 from odt2epub.generator.htmlgenerator import HTMLGenerator
-from odt2epub.generator.epubwriter import EpubWriter
+from odt2epub.generator.epubwriter import EpubWriter, DEFAULT_COMPRESSLEVEL
+from odt2epub.generator.stylesheetgenerator import load_base_selectors
+from odt2epub.cache import ConversionCache, default_cache_dir, imagesize_cache
+from odt2epub.timings import Timings, NULL_TIMINGS
 
 __all__ = []
 __version__ = 0.1
 __date__ = '2015-09-11'
 __updated__ = '2015-09-11'
 
+# Change whenever the epub or html output changes, to invalidate the
+# conversion cache (FINGERPRINT_VERSION does the same for incremental builds)
+OUTPUT_VERSION = 3
+
 # DEBUG = 1
 # TESTRUN = 0
 # PROFILE = 0
@@ -110,6 +121,42 @@ def filetype(path, mode='r'):
     return filename
 
 
+def expand_inputs(paths):
+    '''Expand files, directories and glob patterns into a list of input files'''
+    filenames = []
+    # Output files are named after the input without its extension, so
+    # book.odt and book.txt would overwrite each other (and race under -j)
+    outputs = {}
+    for path in paths:
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            matches = sorted(glob.glob(os.path.join(path, '*.odt')) + glob.glob(os.path.join(path, '*.txt')))
+        elif glob.has_magic(path):
+            # Skip the outputs of previous runs and other non-inputs
+            matches = sorted(glob.glob(path))
+            matches = [match for match in matches
+                       if os.path.isfile(match) and os.path.splitext(match)[1].lower() in ('.odt', '.txt')]
+        else:
+            matches = [path]
+
+        if not matches:
+            message = _gt("no odt or txt file found in '%s'")
+            raise ArgumentTypeError(message % path)
+
+        for match in matches:
+            filename = filetype(match)
+            if filename in filenames:
+                continue
+            output = os.path.normcase(os.path.splitext(filename)[0])
+            if output in outputs:
+                message = _gt("'%s' and '%s' would be converted to the same output file")
+                raise ArgumentTypeError(message % (outputs[output], filename))
+            outputs[output] = filename
+            filenames.append(filename)
+
+    return filenames
+
+
 def parse_cmdline(argv=None):
     '''Parse command line options'''
     if argv is None:
@@ -124,22 +171,174 @@ def parse_cmdline(argv=None):
 
     # Setup argument parser
     parser = ArgumentParser(prog='odt2epub', description=program_shortdesc, formatter_class=RawDescriptionHelpFormatter)
-    parser.add_argument(dest="odtfilename", help=_gt("odt file to convert"), metavar="<odt filename>", type=filetype)
+    parser.add_argument(dest="inputs", help=_gt("odt files, directories or glob patterns to convert"), metavar="<odt filename>", nargs='+')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-v', '--verbose', dest='verbose', action='count', help=_gt('set verbosity level [default: %(default)s]'), default=1)
     group.add_argument('-q', '--quiet', action='store_true', help=_gt('suppress non-error messages'))
     parser.add_argument('--output', choices=['epub', 'html'], type=str.lower, help='output\'s format [default: %(default)s]', default='epub')
+    parser.add_argument('-j', '--jobs', type=int, help=_gt('number of files converted in parallel, 0 for one per CPU [default: %(default)s]'), default=1)
+    parser.add_argument('--chapter-workers', type=int, help=_gt('number of processes rendering the chapters of each epub, 0 for one per CPU [default: %(default)s]'), default=1)
     # parser.add_argument('--input', choices=['odt', 'txt'], type=str.lower, help='input\'s format [default: %(default)s]', default='odt')
     # parser.add_argument('--inline-css', action='store_true', help=_gt('inline generated css'))
     # parser.add_argument('--keep-css-class', action='store_true', help=_gt('keep css class'))
     # parser.add_argument('--export-css', action='store_true', help=_gt('export css'))
     # parser.add_argument('--insert-sigil-toc-id', action='store_true', help=_gt('insert Sigil toc id'))
     # parser.add_argument('--insert-split-marker', action='store_true', help=_gt('insert Sigil split marker before headers'))
+    parser.add_argument('--stylesheet', help=_gt('base css stylesheet, the document styles are merged into it [default: the bundled one]'))
+    parser.add_argument('--optimize-css', action='store_true', help=_gt('merge identical css rules, drop redundant declarations and minify'))
+    parser.add_argument('--compress-level', type=int, help=_gt('deflate level of the epub entries, from 1 (fastest) to 9 (smallest), 0 to store them uncompressed [default: %(default)s]'), default=DEFAULT_COMPRESSLEVEL)
+    parser.add_argument('--incremental', action='store_true', help=_gt('rebuild only the chapters changed since the previous epub'))
+    parser.add_argument('--no-cache', action='store_true', help=_gt('always convert, do not use the conversion and image size caches'))
+    parser.add_argument('--cache-dir', help=_gt('conversion cache directory [default: %(default)s]'), default=default_cache_dir())
+    parser.add_argument('--parser', choices=BACKENDS, help=_gt('odt parsing backend [default: %(default)s]'), default='sax')
+    parser.add_argument('--lazy', action='store_true', help=_gt('parse the odt body while rendering it, to lower peak memory'))
+    parser.add_argument('--pipeline', action='store_true', help=_gt('parse, render and write in separate threads (implies --lazy)'))
+    parser.add_argument('--timings', type=FileType('w', encoding='utf-8'), metavar='FILE', help=_gt('write the time spent in each conversion stage to FILE, one JSON line per file'))
     parser.add_argument('-V', '--version', action='version', version=program_version_message)
     parser.add_argument('-l', '--license', action=_LicenseAction)
 
     # Process arguments
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    try:
+        args.odtfilenames = expand_inputs(args.inputs)
+    except ArgumentTypeError as e:
+        parser.error(str(e))
+
+    if args.jobs < 0:
+        parser.error(_gt('the number of jobs must be positive'))
+
+    if args.chapter_workers < 0:
+        parser.error(_gt('the number of chapter workers must be positive'))
+    args.chapter_workers = args.chapter_workers or os.cpu_count()
+
+    if args.stylesheet:
+        args.stylesheet = os.path.abspath(os.path.expanduser(args.stylesheet))
+        if not os.path.isfile(args.stylesheet):
+            parser.error(_gt("can't open stylesheet '%s'") % args.stylesheet)
+        # Fail once here rather than after parsing every document
+        try:
+            load_base_selectors(args.stylesheet)
+        except Exception as e:  # pylint: disable=broad-except
+            parser.error(_gt("invalid stylesheet: %s") % e)
+
+    if not 0 <= args.compress_level <= 9:
+        parser.error(_gt('the compress level must be between 0 and 9'))
+
+    return args
+
+
+class ConvertOptions:
+    '''Options of convert(), the same for every file of a batch'''
+
+    __slots__ = ('output', 'verbose', 'chapter_workers', 'incremental', 'timed', 'backend', 'lazy', 'pipeline',
+                 'compresslevel', 'stylesheet', 'optimize_css')
+
+    def __init__(self, output='epub', verbose=0, chapter_workers=1, incremental=False, timed=False, backend='sax',
+                 lazy=False, pipeline=False, compresslevel=DEFAULT_COMPRESSLEVEL, stylesheet=None, optimize_css=False):
+        self.output = output
+        self.verbose = verbose
+        self.chapter_workers = chapter_workers
+        self.incremental = incremental
+        # Collect the time spent in each stage (see _convert_job)
+        self.timed = timed
+        self.backend = backend
+        self.lazy = lazy
+        self.pipeline = pipeline
+        self.compresslevel = compresslevel
+        self.stylesheet = stylesheet
+        self.optimize_css = optimize_css
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(output=args.output, verbose=args.verbose, chapter_workers=args.chapter_workers,
+                   incremental=args.incremental, timed=args.timings is not None, backend=args.parser, lazy=args.lazy,
+                   pipeline=args.pipeline, compresslevel=args.compress_level, stylesheet=args.stylesheet,
+                   optimize_css=args.optimize_css)
+
+
+def convert(odtfilename, options=None, cache=None, timings=None):
+    '''Convert a single odt or txt file, return the output filename'''
+    options = options or ConvertOptions()
+    timings = timings or NULL_TIMINGS
+    verbose = options.verbose
+    fname, ext = os.path.splitext(odtfilename)
+
+    if options.output == 'html':
+        outfilenames = ['%s.html' % fname, '%s.css' % fname]
+    elif options.output == 'epub':
+        outfilenames = ['%s.epub' % fname]
+    else:
+        raise Exception(f"Unhandled output format '{options.output}'")
+
+    if cache:
+        with timings.stage('cache_lookup'):
+            key = cache.key(odtfilename, {'output_version': OUTPUT_VERSION, 'output': options.output,
+                                          'incremental': options.incremental, 'compresslevel': options.compresslevel,
+                                          'optimize_css': options.optimize_css}, options.stylesheet)
+            hit = cache.get(key, outfilenames)
+        if hit:
+            timings.count('cache_hit')
+            if verbose > 0:
+                print(_gt('Cached:  %s') % outfilenames[0])
+            return outfilenames[0]
+
+    # Shared assets (series covers, logos) are probed once across conversions
+    imagesizes = imagesize_cache(cache.cache_dir) if cache else None
+
+    if ext == '.odt':
+        parser = OdtParser(timings=timings, backend=options.backend, imagesizes=imagesizes)
+        if options.lazy or options.pipeline:
+            document = parser.parse_lazy(odtfilename, verbose)
+        else:
+            document = parser.parse(odtfilename, verbose)
+    elif ext == '.txt':
+        parser = TxtParser(timings=timings)
+        document = parser.parse(odtfilename, verbose)
+    else:
+        raise Exception(f"Unhandled input format '{ext}'")
+
+    if options.output == 'html':
+        generator = HTMLGenerator(document, flat_html=True, verbose=verbose, timings=timings, pipeline=options.pipeline,
+                                  stylesheet=options.stylesheet, optimize_css=options.optimize_css)
+        generator.write(outfilenames[0])
+    else:
+        writer = EpubWriter(document, verbose=verbose, workers=options.chapter_workers, incremental=options.incremental,
+                            timings=timings, pipeline=options.pipeline, compresslevel=options.compresslevel,
+                            stylesheet=options.stylesheet, optimize_css=options.optimize_css, imagesizes=imagesizes)
+        writer.write(outfilenames[0])
+        # shutil.copy(epubfilename, '%s.zip' % fname)
+
+    if cache:
+        with timings.stage('cache_store'):
+            cache.put(key, outfilenames)
+            imagesizes.save()
+
+    return outfilenames[0]
+
+
+def _convert_job(odtfilename, options, cache):
+    '''Run convert() isolating failures, so one bad file does not abort a batch'''
+    timings = Timings() if options.timed else None
+    try:
+        outfilename = convert(odtfilename, options, cache, timings)
+        error = None
+    except Exception:  # pylint: disable=broad-except
+        outfilename = None
+        error = traceback.format_exc()
+    return odtfilename, outfilename, error, timings.as_dict() if timings else None
+
+
+def _report(odtfilename, outfilename, error, timings, verbose, timingsfile):
+    if error:
+        sys.stderr.write(_gt('FAILED:  %s') % odtfilename + '\n')
+        sys.stderr.write(error if verbose > 1 else error.strip().splitlines()[-1] + '\n')
+    elif verbose > 0:
+        print(_gt('OK:      %s -> %s') % (odtfilename, outfilename))
+
+    if timings is not None:
+        # Kept out of stdout, where they would be mixed with the messages
+        timingsfile.write(json.dumps({'file': odtfilename, **timings}) + '\n')
 
 
 def main(argv=None):
@@ -149,29 +348,33 @@ def main(argv=None):
     if args.quiet:
         args.verbose = 0
 
-    __, ext = os.path.splitext(args.odtfilename)
+    # Largest files first, so the longest conversions do not end up last
+    odtfilenames = sorted(args.odtfilenames, key=os.path.getsize, reverse=True)
 
-    if ext == '.odt':
-        parser = OdtParser()
-        document = parser.parse(args.odtfilename, args.verbose)
-    elif ext == '.txt':
-        parser = TxtParser()
-        document = parser.parse(args.odtfilename, args.verbose)
+    cache = None if args.no_cache else ConversionCache(args.cache_dir)
+    options = ConvertOptions.from_args(args)
+
+    jobs = args.jobs or os.cpu_count()
+    jobs = min(jobs, len(odtfilenames))
+
+    failures = 0
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_convert_job, odtfilename, options, cache) for odtfilename in odtfilenames]
+            for future in as_completed(futures):
+                odtfilename, outfilename, error, timings = future.result()
+                _report(odtfilename, outfilename, error, timings, args.verbose, args.timings)
+                failures += error is not None
     else:
-        raise Exception(f"Unhandled input format '{ext}'")
+        for odtfilename in odtfilenames:
+            odtfilename, outfilename, error, timings = _convert_job(odtfilename, options, cache)
+            _report(odtfilename, outfilename, error, timings, args.verbose, args.timings)
+            failures += error is not None
 
-    if args.output == 'html':
-        fname, __ = os.path.splitext(args.odtfilename)
-        htmlfilename = '%s.html' % fname
+    if len(odtfilenames) > 1 and args.verbose > 0:
+        print(ngettext('%d file converted, %d failed', '%d files converted, %d failed', len(odtfilenames)) % (len(odtfilenames) - failures, failures))
 
-        generator = HTMLGenerator(document, flat_html=True, verbose=args.verbose)
-        generator.write(htmlfilename)
-    elif args.output == 'epub':
-        fname, __ = os.path.splitext(args.odtfilename)
-        epubfilename = '%s.epub' % fname
+    if args.timings:
+        args.timings.close()
 
-        writer = EpubWriter(document, verbose=args.verbose)
-        writer.write(epubfilename)
-        # shutil.copy(epubfilename, '%s.zip' % fname)
-    else:
-        raise Exception(f"Unhandled output format '{args.format}'")
+    return 1 if failures else 0
@@ -0,0 +1,296 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks: concurrent saves may drop each other's new entries
+    fcntl = None
+
+from odt2epub import imagesize
+from odt2epub.contenthandler import PICTURES_DIR
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# Image size cache file, in the conversion cache directory (skipped by evict)
+IMAGESIZE_CACHE_NAME = '.imagesize.json'
+DEFAULT_MAX_IMAGES = 10000
+IMAGESIZE_CACHE_VERSION = 1
+
+# The odt members the conversion depends on, besides the embedded images
+ODT_MEMBERS = ('styles.xml', 'content.xml')
+
+# Bump whenever the inputs hashed by ConversionCache.key change
+CACHE_FORMAT = 2
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def default_cache_dir():
+    cachehome = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cachehome, 'odt2epub')
+
+
+class ConversionCache:
+    '''On-disk cache of converted files, keyed by a hash of their inputs.
+
+    Every entry is a directory holding the output files. Entries are evicted
+    least recently used first once the cache grows over max_size bytes.
+    Entries are published with an atomic rename, so concurrent processes can
+    share the same cache directory.
+    '''
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_size = max_size
+
+    def key(self, infilename, options, stylesheet=None):
+        '''Hash the relevant input data, the output basename and the options'''
+        digest = hashlib.sha256()
+        digest.update(f'format={CACHE_FORMAT}\0'.encode('utf-8'))
+        for name, value in sorted(options.items()):
+            digest.update(f'{name}={value}\0'.encode('utf-8'))
+
+        fname, ext = os.path.splitext(infilename)
+        workingdir, basename = os.path.split(fname)
+        # The basename ends up in the output (epub title, html title and css link)
+        digest.update(f'basename={basename}\0'.encode('utf-8'))
+
+        if ext.lower() == '.odt':
+            with zipfile.ZipFile(infilename) as odtfile:
+                for member in ODT_MEMBERS:
+                    digest.update(f'{member}\0'.encode('utf-8'))
+                    with odtfile.open(member) as stream:
+                        _update_digest(digest, stream)
+                # Copied into the epub as they are: the zip directory identifies them
+                for info in sorted(odtfile.infolist(), key=lambda info: info.filename):
+                    if info.filename.startswith(PICTURES_DIR):
+                        digest.update(f'{info.filename}\0{info.CRC:08x}\0{info.file_size}\0'.encode('utf-8'))
+        else:
+            with open(infilename, 'rb') as stream:
+                _update_digest(digest, stream)
+
+        coverfn = os.path.join(workingdir, 'cover.jpg')
+        if os.path.isfile(coverfn):
+            digest.update(b'cover.jpg\0')
+            with open(coverfn, 'rb') as stream:
+                _update_digest(digest, stream)
+
+        if stylesheet:
+            digest.update(b'stylesheet\0')
+            with open(stylesheet, 'rb') as stream:
+                _update_digest(digest, stream)
+
+        return digest.hexdigest()
+
+    def get(self, key, outfilenames):
+        '''Copy a cached entry to outfilenames, return False on a miss'''
+        entrydir = os.path.join(self.cache_dir, key)
+        try:
+            for idx, outfilename in enumerate(outfilenames):
+                shutil.copyfile(os.path.join(entrydir, str(idx)), outfilename)
+            # Mark as recently used
+            os.utime(entrydir)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, outfilenames):
+        entrydir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entrydir):
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            for idx, outfilename in enumerate(outfilenames):
+                shutil.copyfile(outfilename, os.path.join(tmpdir, str(idx)))
+            os.rename(tmpdir, entrydir)
+        except OSError:
+            # Most likely another process stored the same entry meanwhile
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits in max_size'''
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return
+
+        for name in names:
+            if name.startswith('.'):
+                continue
+            entrydir = os.path.join(self.cache_dir, name)
+            try:
+                mtime = os.stat(entrydir).st_mtime
+                size = sum(entry.stat().st_size for entry in os.scandir(entrydir))
+            except OSError:
+                continue
+            entries.append((mtime, size, entrydir))
+            total += size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            __, size, entrydir = entries.pop(0)
+            shutil.rmtree(entrydir, ignore_errors=True)
+            total -= size
+
+
+class ImageSizeCache:
+    '''Persistent cache of imagesize.get and imagesize.getDPI results.
+
+    Files are keyed by (path, mtime, size), streams by a key identifying
+    their content given by the caller, so a hit reads nothing from them.
+    Other sources are not cached.
+
+    The key of a zip member is its CRC-32 and sizes, read from the zip
+    directory. CRC-32 is not a content hash: two images of equal sizes and
+    equal CRC would share an entry and one of them would get the other's
+    dimensions. Accidental collisions are unlikely enough for a width and
+    height attribute, while a real digest would mean decompressing every
+    image again, which is what a hit saves.
+
+    The entries are loaded once, then looked up in memory. save() merges the
+    new entries with those saved meanwhile by other processes, keeps the
+    max_entries most recently used and publishes the file with an atomic
+    rename, under an advisory lock so that concurrent processes do not drop
+    each other's entries. Readers never wait.
+    '''
+
+    def __init__(self, filename, max_entries=DEFAULT_MAX_IMAGES):
+        self.filename = filename
+        self.max_entries = max_entries
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def get(self, filepath, key=None):
+        return self._lookup('size', imagesize.get, filepath, key)
+
+    def getDPI(self, filepath, key=None):
+        return self._lookup('dpi', imagesize.getDPI, filepath, key)
+
+    def _lookup(self, field, function, filepath, key):
+        if key is not None:
+            key = f'stream:{key}'
+        elif isinstance(filepath, (str, os.PathLike)):
+            stat = os.stat(filepath)
+            key = f'file:{os.path.abspath(filepath)}:{stat.st_mtime_ns}:{stat.st_size}'
+        else:
+            return function(filepath)
+
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            entry = self._entries.get(key)
+            if entry and field in entry:
+                # LRU order, saved along with the next new entry
+                entry['used'] = int(time.time())
+                return tuple(entry[field])
+
+        value = function(filepath)
+
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            entry[field] = value
+            entry['used'] = int(time.time())
+            self._dirty = True
+        return value
+
+    def _load(self):
+        try:
+            with open(self.filename, encoding='utf-8') as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != IMAGESIZE_CACHE_VERSION:
+            return {}
+        return data['entries']
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                with open(self.filename + '.lock', 'ab') as lockfile:
+                    if fcntl:
+                        fcntl.flock(lockfile, fcntl.LOCK_EX)
+                    self._merge_and_write()
+            except OSError:
+                # Only a cache, try again with the next new entry
+                return
+            self._dirty = False
+
+    def _merge_and_write(self):
+        '''Merge the entries with the saved ones and replace the file, holding the lock'''
+        entries = self._load()
+        for key, entry in self._entries.items():
+            saved = entries.get(key)
+            if saved and saved['used'] > entry['used']:
+                entries[key] = {**entry, **saved}
+            else:
+                entries[key] = {**(saved or {}), **entry}
+        if len(entries) > self.max_entries:
+            keys = sorted(entries, key=lambda key: entries[key]['used'], reverse=True)
+            entries = {key: entries[key] for key in keys[:self.max_entries]}
+        self._entries = entries
+
+        fd, tmpfilename = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(self.filename))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fout:
+                json.dump({'version': IMAGESIZE_CACHE_VERSION, 'entries': entries}, fout)
+            os.replace(tmpfilename, self.filename)
+        except OSError:
+            os.remove(tmpfilename)
+            raise
+
+
+# ImageSizeCache instances of this process, by filename
+_imagesize_caches = {}
+
+
+def imagesize_cache(cache_dir=None):
+    '''Return the ImageSizeCache of cache_dir, shared by the conversions of this process'''
+    filename = os.path.join(cache_dir or default_cache_dir(), IMAGESIZE_CACHE_NAME)
+    cache = _imagesize_caches.get(filename)
+    if cache is None:
+        cache = _imagesize_caches[filename] = ImageSizeCache(filename)
+    return cache
+
+
+def _update_digest(digest, stream):
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
@@ -16,21 +16,39 @@ along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
 
 Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
 '''
-import sys
-
+import mimetypes
 import xml.sax.handler
 
+from odt2epub.diagnostics import Diagnostics
+
+
+# Kinds of the events reported to Diagnostics
+LIST_CONTINUE_NUMBERING = 'list with continue numbering (ignored)'
+LIST_WITHOUT_STYLE = 'list without a list style (skipped)'
+UNHANDLED_CONTENT = 'text outside a paragraph (skipped)'
+IMAGE_NOT_EMBEDDED = 'linked image, not embedded in the odt (skipped)'
+IMAGE_OUTSIDE_PARAGRAPH = 'image outside a paragraph (skipped)'
+
+# Embedded images live in this directory of the odt
+PICTURES_DIR = 'Pictures/'
+
+# Epub image name of the external cover (see EpubWriter._load_cover)
+COVER_IMAGE = 'cover.jpg'
+
 
 class Paragraph:
 
+    __slots__ = ('style', 'attrs', 'content')
+
     def __init__(self, style, attrs):
         self.style = style
-        self.attrs = attrs
+        # Plain dict, do not keep the SAX AttributesImpl wrapper alive
+        self.attrs = dict(attrs.items()) if attrs is not None else None
 
         self.content = []
 
     def append(self, typ, content, style=None):
-        self.content.append((typ, content, style))
+        _append_content(self.content, typ, content, style)
 
     def get_style_display_name(self):
         return self.style.get_display_name()
@@ -41,6 +59,8 @@ class Paragraph:
 
 class Header(Paragraph):
 
+    __slots__ = ()
+
     def get_level(self):
         # return self.attrs.get('text:outline-level')
         return self.get_style_display_name().replace('Heading ', '')
@@ -48,6 +68,8 @@ class Header(Paragraph):
 
 class List():
 
+    __slots__ = ('list_style', 'items')
+
     def __init__(self, list_style):
         self.list_style = list_style
 
@@ -59,6 +81,8 @@ class List():
 
 class ListItem():
 
+    __slots__ = ('paragraps',)
+
     def __init__(self):
         self.paragraps = []
 
@@ -68,6 +92,8 @@ class ListItem():
 
 class Note:
 
+    __slots__ = ('noteclass', 'id', 'citation', 'content')
+
     def __init__(self, attrs):
         self.noteclass = attrs['text:note-class']
         self.id = attrs['text:id']
@@ -79,30 +105,93 @@ class Note:
         self.citation = citation
 
     def append(self, typ, content, style):
-        self.content.append((typ, content, style))
+        _append_content(self.content, typ, content, style)
+
+
+class Image:
+    '''An image embedded in the odt, shared by all the places showing it'''
+
+    __slots__ = ('href', 'name', 'media_type', 'alt', 'width', 'height', 'embedded')
+
+    def __init__(self, href):
+        self.href = href
+        self.name = _image_name(href[len(PICTURES_DIR):])
+        self.media_type = mimetypes.guess_type(self.name)[0]
+        self.alt = ''
+
+        # Set by the parser once the image is found in the odt
+        self.width = -1
+        self.height = -1
+        self.embedded = False
+
+
+def _image_name(name):
+    '''Epub name of a picture, never the cover one.
+
+    The cover name and the names starting with '_' get a '_' prefix: no
+    two pictures get the same name.
+    '''
+    if name == COVER_IMAGE or name.startswith('_'):
+        return '_' + name
+    return name
+
+
+def _append_content(content, typ, text, style):
+    '''Append to content, merging adjacent text runs that share the same style.
+
+    ContentHandler joins the characters() fragments of a run before appending
+    it, runs only meet here across the paragraphs of a note.
+    '''
+    if typ == 'str' and content:
+        lasttyp, lasttext, laststyle = content[-1]
+        if lasttyp == 'str' and laststyle is style:
+            content[-1] = (typ, lasttext + text, style)
+            return
+    content.append((typ, text, style))
 
 
 class ContentHandler(xml.sax.handler.ContentHandler):
 
-    def __init__(self, odtfilename, document):
+    def __init__(self, odtfilename, document, diagnostics=None):
         super().__init__()
         self.odtfilename = odtfilename
+        self.diagnostics = diagnostics or Diagnostics(verbose=0)
         self.styles = document.styles
         self.paragraps = document.paragraps
         self.notes = document.notes
+        self.images = document.images
 
         self.current_paragraph = None
         self.current_span_style = None
         self.current_list = None
         self.current_list_item = None
 
+        # Fragments of the text run being parsed, appended to _text_target
+        # as a single string once something else is appended or it closes
+        self._text = []
+        self._text_target = None
+        self._text_style = None
+
         self.current_note = None
         self.current_note_citation = False
 
-        self.debug_current_list_with_continue_numbering = False
+        # Lists and notes being parsed: blocks started inside them do not
+        # complete the top level block before them (see LazyBlocks)
+        self.open_blocks = 0
+
+        self.current_image = None
+        # Text of the svg:title or svg:desc of current_image
+        self.current_image_text = None
 
         self.in_tableofcontents = False
 
+    def endDocument(self):
+        self._flush_text()
+
+    def in_open_block(self):
+        '''True while a list or a note is being parsed'''
+        return self.open_blocks > 0
+
     def startElement(self, name, attrs):
         # print("startElement " + name)
 
@@ -110,83 +199,176 @@ class ContentHandler(xml.sax.handler.ContentHandler):
             # Inside TOC ignore everything
             return
 
-        if name == 'text:h':
-            style = self.styles[attrs['text:style-name']]
-            self.current_paragraph = Header(style, attrs)
-            self.paragraps.append(self.current_paragraph)
-        elif name == 'text:note':
-            self.current_note = Note(attrs)
-        elif name == 'text:note-citation':
-            self.current_note_citation = True
-        elif name == 'text:p':
-            if self.current_note:
-                pass
-            else:
-                style = self.styles[attrs['text:style-name']]
-                self.current_paragraph = Paragraph(style, attrs)
-                if self.current_list_item:
-                    self.current_list_item.append(self.current_paragraph)
-                else:
-                    self.paragraps.append(self.current_paragraph)
-        elif name == 'text:span':
-            self.current_span_style = self.styles[attrs['text:style-name']]
-        elif name == 'text:list':
-            if 'text:continue-numbering' in attrs:
-                sys.stderr.write('!!!!!!!!!!!!!!!!!!!!!!!!!!!\n')
-                sys.stderr.write(f'Current List With Continue Numbering: {self.odtfilename}\n')
-                self.debug_current_list_with_continue_numbering = True
-            try:
-                sys.stderr.write(str(attrs._attrs) + '\n')
-                style = self.styles[attrs['text:style-name']]
-                self.current_list = List(style.properties['list-style'])
-                self.paragraps.append(self.current_list)
-            except:
-                sys.stderr.write(str(attrs._attrs) + '\n')
-                
-        elif name == 'text:list-item':
-            try:
-                self.current_list_item = ListItem()
-                self.current_list.append(self.current_list_item)
-            except:
-                pass
-        elif name == 'text:line-break':
-            self.current_paragraph.append('line-break', '')
-        elif name == 'text:table-of-content':
-            self.in_tableofcontents = True
+        handler = self.START_HANDLERS.get(name)
+        if handler:
+            handler(self, attrs)
 
     def endElement(self, name):
         # print("endElement " + name)
-        if name == 'text:table-of-content':
-            self.in_tableofcontents = False
-            return
-
-        if self.in_tableofcontents:
+        if self.in_tableofcontents and name != 'text:table-of-content':
             # Inside TOC ignore everything
             return
 
-        if name == 'text:note':
-            self.notes.append(self.current_note)
-            self.current_paragraph.append('note', self.current_note)
-            self.current_note = None
-        elif name == 'text:note-citation':
-            self.current_note_citation = False
-        elif name == 'text:p':
-            if self.current_note:
-                pass
+        handler = self.END_HANDLERS.get(name)
+        if handler:
+            handler(self)
+
+    def _append_text(self, target, text, style):
+        if target is not self._text_target or style is not self._text_style:
+            self._flush_text()
+            self._text_target = target
+            self._text_style = style
+        self._text.append(text)
+
+    def _flush_text(self):
+        if self._text:
+            self._text_target.append('str', ''.join(self._text), self._text_style)
+            self._text.clear()
+        self._text_target = None
+
+    def _start_header(self, attrs):
+        self._flush_text()
+        style = self.styles[attrs['text:style-name']]
+        self.current_paragraph = Header(style, attrs)
+        self.paragraps.append(self.current_paragraph)
+
+    def _start_note(self, attrs):
+        self._flush_text()
+        self.current_note = Note(attrs)
+        self.open_blocks += 1
+
+    def _start_note_citation(self, attrs):
+        self.current_note_citation = True
+
+    def _start_paragraph(self, attrs):
+        self._flush_text()
+        if self.current_note:
+            pass
+        else:
+            style = self.styles[attrs['text:style-name']]
+            self.current_paragraph = Paragraph(style, attrs)
+            if self.current_list_item:
+                self.current_list_item.append(self.current_paragraph)
             else:
-                if self.debug_current_list_with_continue_numbering:
-                    sys.stderr.write(f'\t-> {self.current_paragraph.content[0][0]}\n')
-                    self.debug_current_list_with_continue_numbering = False
-                self.current_paragraph = None
-        elif name == 'text:span':
-            self.current_span_style = None
-        elif name == 'text:list':
-            self.current_list = None
-        elif name == 'text:list-item':
-            self.current_list_item = None
-        elif name == 'text:table-of-content':
-            print('Stop TOC')
-            self.in_tableofcontents = False
+                self.paragraps.append(self.current_paragraph)
+
+    def _start_span(self, attrs):
+        self.current_span_style = self.styles[attrs['text:style-name']]
+
+    def _start_list(self, attrs):
+        self._flush_text()
+        if 'text:continue-numbering' in attrs:
+            self.diagnostics.report(LIST_CONTINUE_NUMBERING, 'text:style-name %s', attrs.get('text:style-name'))
+        try:
+            style = self.styles[attrs['text:style-name']]
+            self.current_list = List(style.properties['list-style'])
+            self.paragraps.append(self.current_list)
+        except KeyError:
+            self.diagnostics.report(LIST_WITHOUT_STYLE, '%s', dict(attrs.items()))
+        self.open_blocks += 1
+
+    def _start_list_item(self, attrs):
+        self._flush_text()
+        try:
+            self.current_list_item = ListItem()
+            self.current_list.append(self.current_list_item)
+        except:
+            pass
+
+    def _start_line_break(self, attrs):
+        self._flush_text()
+        self.current_paragraph.append('line-break', '')
+
+    def _start_image(self, attrs):
+        self._flush_text()
+        href = attrs.get('xlink:href', '')
+        if not href.startswith(PICTURES_DIR):
+            self.diagnostics.report(IMAGE_NOT_EMBEDDED, '%s', href)
+            return
+        if self.current_paragraph is None:
+            self.diagnostics.report(IMAGE_OUTSIDE_PARAGRAPH, '%s', href)
+            return
+
+        image = self.images.get(href)
+        if image is None:
+            image = self.images[href] = Image(href)
+        if self.current_note:
+            self.current_note.append('image', image, None)
+        else:
+            self.current_paragraph.append('image', image)
+        self.current_image = image
+
+    def _start_image_text(self, attrs):
+        if self.current_image:
+            self.current_image_text = []
+
+    def _start_table_of_content(self, attrs):
+        self.in_tableofcontents = True
+
+    def _end_table_of_content(self):
+        self.in_tableofcontents = False
+
+    def _end_frame(self):
+        self.current_image = None
+
+    def _end_image_title(self):
+        if self.current_image_text is not None and not self.current_image.alt:
+            self.current_image.alt = ''.join(self.current_image_text).strip()
+        self.current_image_text = None
+
+    def _end_image_desc(self):
+        self.current_image_text = None
+
+    def _end_note(self):
+        self._flush_text()
+        self.notes.append(self.current_note)
+        self.current_paragraph.append('note', self.current_note)
+        self.current_note = None
+        self.open_blocks -= 1
+
+    def _end_note_citation(self):
+        self.current_note_citation = False
+
+    def _end_paragraph(self):
+        self._flush_text()
+        if self.current_note:
+            pass
+        else:
+            self.current_paragraph = None
+
+    def _end_span(self):
+        self.current_span_style = None
+
+    def _end_list(self):
+        self.current_list = None
+        self.open_blocks -= 1
+
+    def _end_list_item(self):
+        self.current_list_item = None
+
+    START_HANDLERS = {'text:h': _start_header,
+                      'text:note': _start_note,
+                      'text:note-citation': _start_note_citation,
+                      'text:p': _start_paragraph,
+                      'text:span': _start_span,
+                      'text:list': _start_list,
+                      'text:list-item': _start_list_item,
+                      'text:line-break': _start_line_break,
+                      'draw:image': _start_image,
+                      'svg:title': _start_image_text,
+                      'svg:desc': _start_image_text,
+                      'text:table-of-content': _start_table_of_content}
+
+    END_HANDLERS = {'text:note': _end_note,
+                    'text:note-citation': _end_note_citation,
+                    'text:p': _end_paragraph,
+                    'text:span': _end_span,
+                    'text:list': _end_list,
+                    'text:list-item': _end_list_item,
+                    'draw:frame': _end_frame,
+                    'svg:title': _end_image_title,
+                    'svg:desc': _end_image_desc,
+                    'text:table-of-content': _end_table_of_content}
 
     def characters(self, content):
         # print("\t\t" + content)
@@ -195,11 +377,14 @@ class ContentHandler(xml.sax.handler.ContentHandler):
             # Inside TOC ignore everything
             return
 
-        if self.current_note_citation:
-            self.current_note.set_citation(content)
+        if self.current_image_text is not None:
+            self.current_image_text.append(content)
+        elif self.current_note_citation:
+            # A few characters, possibly split across fragments
+            self.current_note.set_citation(self.current_note.citation + content)
         elif self.current_note:
-            self.current_note.append('str', content, self.current_span_style)
+            self._append_text(self.current_note, content, self.current_span_style)
         elif self.current_paragraph:
-            self.current_paragraph.append('str', content, self.current_span_style)
+            self._append_text(self.current_paragraph, content, self.current_span_style)
         else:
-            sys.stderr.write('WARNING: Unhandled content: %s\n' % content)
+            self.diagnostics.report(UNHANDLED_CONTENT, '%r', content)
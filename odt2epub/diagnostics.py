@@ -0,0 +1,72 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+import sys
+
+from odt2epub import _gt
+
+
+# Samples kept for each kind of event at verbosity 2, every event from 3 on
+DEFAULT_MAX_SAMPLES = 5
+
+
+class Diagnostics:
+    '''Count the anomalies found while converting, report them once at the end.
+
+    Events are recorded as a format string and its arguments, only the
+    samples printed in the summary are ever formatted. The verbosity
+    selects the detail of the summary:
+        0: nothing
+        1: one line per kind of event, with its count
+        2: also the first max_samples events of each kind
+        3: every event
+    '''
+
+    def __init__(self, verbose=1, max_samples=DEFAULT_MAX_SAMPLES):
+        self.verbose = verbose
+        if verbose > 2:
+            self.max_samples = None
+        elif verbose > 1:
+            self.max_samples = max_samples
+        else:
+            self.max_samples = 0
+
+        self.counts = {}
+        self.samples = {}
+
+    def report(self, kind, message, *args):
+        count = self.counts.get(kind, 0)
+        self.counts[kind] = count + 1
+        if self.max_samples is None or count < self.max_samples:
+            self.samples.setdefault(kind, []).append((message, args))
+
+    def summary(self, filename):
+        lines = []
+        for kind, count in self.counts.items():
+            lines.append(_gt('%s: %d x %s') % (filename, count, _gt(kind)))
+            for message, args in self.samples.get(kind, ()):
+                lines.append('\t' + (message % args if args else message))
+            omitted = count - len(self.samples.get(kind, ()))
+            if self.samples.get(kind) and omitted:
+                lines.append('\t' + _gt('... %d more') % omitted)
+        return '\n'.join(lines)
+
+    def print_summary(self, filename, out=None):
+        if self.verbose > 0 and self.counts:
+            out = out or sys.stderr
+            out.write(self.summary(filename) + '\n')
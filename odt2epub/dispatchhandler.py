@@ -0,0 +1,55 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+from xml.sax.handler import ContentHandler
+
+
+class DispatchHandler(ContentHandler):
+    '''Fan out the SAX events of a single traversal to several handlers.
+
+    Handlers are notified in the given order, so a StyleHandler placed before
+    a ContentHandler registers each automatic style before the body refers to it.
+    '''
+
+    def __init__(self, *handlers):
+        super().__init__()
+        self.handlers = handlers
+
+    def setDocumentLocator(self, locator):
+        for handler in self.handlers:
+            handler.setDocumentLocator(locator)
+
+    def startDocument(self):
+        for handler in self.handlers:
+            handler.startDocument()
+
+    def endDocument(self):
+        for handler in self.handlers:
+            handler.endDocument()
+
+    def startElement(self, name, attrs):
+        for handler in self.handlers:
+            handler.startElement(name, attrs)
+
+    def endElement(self, name):
+        for handler in self.handlers:
+            handler.endElement(name)
+
+    def characters(self, content):
+        for handler in self.handlers:
+            handler.characters(content)
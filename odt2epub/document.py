@@ -26,9 +26,90 @@ class Document:
         self.styles = {}
         self.paragraps = []
         self.notes = []
+        # href in the odt -> Image
+        self.images = {}
+
+        # display name -> style, first style registered wins
+        self._styles_by_display_name = {}
+
+    def add_style(self, style):
+        replacing = style.name in self.styles
+        self.styles[style.name] = style
+
+        if replacing:
+            # Rare: rebuild so the index matches a scan of self.styles
+            self._styles_by_display_name = {}
+            for other in self.styles.values():
+                self._styles_by_display_name.setdefault(other.get_display_name(True), other)
+        else:
+            self._styles_by_display_name.setdefault(style.get_display_name(True), style)
 
     def get_style_by_display_name(self, display_name):
-        for style in self.styles.values():
-            if style.get_display_name(True) == display_name:
-                return style
-        raise Exception(f'No style found for name "{display_name}"')
+        try:
+            return self._styles_by_display_name[display_name]
+        except KeyError:
+            raise Exception(f'No style found for name "{display_name}"') from None
+
+
+class LazyDocument(Document):
+    '''Document whose body is parsed while its blocks are iterated.
+
+    Styles are available as soon as the document is returned, paragraps is a
+    LazyBlocks which can be iterated only once: the blocks already consumed,
+    and their notes, are not kept.
+    '''
+
+    def __init__(self, odtfilename):
+        super().__init__(odtfilename)
+        self.paragraps = LazyBlocks()
+
+    def close(self):
+        '''Stop parsing, needed only when paragraps is not iterated to the end'''
+        self.paragraps.close()
+
+
+class LazyBlocks:
+    '''Top level blocks of a LazyDocument, pulled from the parser on demand.
+
+    source advances the parser by a chunk at every step, the parser append()s
+    each block as soon as it starts: a block is complete once the next one
+    has started while block_open() is false (a heading inside a list item is
+    appended here too), or source is exhausted.
+    '''
+
+    def __init__(self):
+        self.source = None
+        # Set by the parser, true while a list or note is being parsed
+        self.block_open = None
+        self.count = 0
+        self._pending = []
+        # Number of pending blocks known to be complete
+        self._complete = 0
+        self._iterated = False
+
+    def append(self, block):
+        if not (self.block_open and self.block_open()):
+            self._complete = len(self._pending)
+        self._pending.append(block)
+        self.count += 1
+
+    def __iter__(self):
+        if self._iterated:
+            raise Exception('The blocks of a lazy document can be iterated only once')
+        self._iterated = True
+
+        pending = self._pending
+        for __ in self.source:
+            if self._complete:
+                ready = pending[:self._complete]
+                del pending[:self._complete]
+                self._complete = 0
+                yield from ready
+
+        ready = pending[:]
+        pending.clear()
+        yield from ready
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
@@ -0,0 +1,91 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+from xml.parsers import expat
+from xml.sax.handler import ContentHandler
+
+
+class ExpatReader:
+    '''Incremental parser driving the handlers straight from xml.parsers.expat.
+
+    Drop-in for the incremental SAX reader (feed, close) when all the handlers
+    have START_HANDLERS and END_HANDLERS dispatch tables: attributes are passed
+    as plain dicts instead of AttributesImpl, the elements no handler has in
+    its tables are dropped inside the routing lookup, and text is buffered so
+    characters() receives whole runs instead of arbitrary fragments.
+
+    The handlers' own startElement and endElement look the elements up in the
+    same tables, so the SAX backend and this one share them.
+    '''
+
+    def __init__(self, *handlers, buffer_size=64 * 1024):
+        self.handlers = handlers
+
+        self._start_routes = _routes(handlers, 'START_HANDLERS', 'startElement')
+        self._end_routes = _routes(handlers, 'END_HANDLERS', 'endElement')
+
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.buffer_size = buffer_size
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+
+        characters = [handler.characters for handler in handlers
+                      if type(handler).characters is not ContentHandler.characters]
+        if len(characters) == 1:
+            self._parser.CharacterDataHandler = characters[0]
+        elif characters:
+            self._parser.CharacterDataHandler = _fan_out(characters)
+
+        for handler in handlers:
+            handler.startDocument()
+
+    def _start_element(self, name, attrs):
+        route = self._start_routes.get(name)
+        if route:
+            route(name, attrs)
+
+    def _end_element(self, name):
+        route = self._end_routes.get(name)
+        if route:
+            route(name)
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse(b'', True)
+        for handler in self.handlers:
+            handler.endDocument()
+
+
+def _routes(handlers, table, method):
+    '''Map every element name to the method of the handlers interested in it'''
+    methods = {}
+    for handler in handlers:
+        for name in getattr(handler, table):
+            methods.setdefault(name, []).append(getattr(handler, method))
+    return {name: functions[0] if len(functions) == 1 else _fan_out(functions)
+            for name, functions in methods.items()}
+
+
+def _fan_out(functions):
+    def call_all(*args):
+        for function in functions:
+            function(*args)
+    return call_all
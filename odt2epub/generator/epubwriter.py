@@ -1,19 +1,52 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
+import hashlib
+import json
 import os
+from urllib.parse import quote
 import uuid
 import zipfile
 
 from odt2epub import _gt, imagesize
 from odt2epub.generator.htmlgenerator import HTMLGenerator
+from odt2epub.generator.ziputils import copy_raw_entry, deflate, write_deflated_entry
+from odt2epub.pipeline import ThreadedIterator
+from odt2epub.timings import NULL_TIMINGS
+
+# Chapter fingerprints and TOC data of an incremental build
+METADATA_NAME = 'META-INF/odt2epub.json'
+METADATA_VERSION = 1
+
+# zlib level of the entries, 0 stores them uncompressed
+DEFAULT_COMPRESSLEVEL = 6
 
 
 class EpubWriter:
 
-    def __init__(self, document, verbose=0):
+    def __init__(self, document, verbose=0, workers=1, incremental=False, timings=None, pipeline=False,
+                 compresslevel=DEFAULT_COMPRESSLEVEL, compress_workers=None, stylesheet=None,
+                 optimize_css=False, imagesizes=None):
         self.document = document
         self.verbose = verbose
+        self.workers = workers
+        self.timings = timings or NULL_TIMINGS
+        # Reuse the unchanged chapters of a previous incremental build
+        self.incremental = incremental
+        # Parse, render and write in separate threads connected by bounded queues
+        self.pipeline = pipeline
+        self.compresslevel = compresslevel
+        # Threads deflating the chapters, zlib releases the GIL
+        self.compress_workers = compress_workers or os.cpu_count()
+        self._pending_chapters = deque()
+        self.stylesheet = stylesheet
+        # Smaller, minified stylesheet
+        self.optimize_css = optimize_css
+        # Optional odt2epub.cache.ImageSizeCache, for the cover
+        self.imagesizes = imagesizes
 
         self.playorder = 0
-        self.toctxt = ''
+        self.tocparts = []
 
     def write(self, epubfilename):
         if self.verbose > 0:
@@ -22,71 +55,235 @@ class EpubWriter:
         fname, __ = os.path.splitext(epubfilename)
         workingdir, basename, = os.path.split(fname)
 
-        epubuuid = uuid.uuid4()
+        self._pending_chapters.clear()
+
+        previous, metadata = self._open_previous(epubfilename)
+
+        if metadata:
+            epubuuid = metadata['epubuuid']
+        else:
+            epubuuid = uuid.uuid4()
+
+        generator = HTMLGenerator(self.document, flat_html=False, verbose=self.verbose, workers=self.workers, timings=self.timings,
+                                  pipeline=self.pipeline, stylesheet=self.stylesheet,
+                                  optimize_css=self.optimize_css)
+
+        # Renamed once complete: the previous epub is still read while writing
+        # the new one, and a lazy document can fail to parse halfway
+        outfilename = f'{epubfilename}.tmp'
+
+        try:
+            compression = zipfile.ZIP_DEFLATED if self.compresslevel else zipfile.ZIP_STORED
+            with zipfile.ZipFile(outfilename, 'w', compression, compresslevel=self.compresslevel or None) as epub, \
+                    ThreadPoolExecutor(self.compress_workers) if self.compresslevel else nullcontext() as executor:
+                # Required by EPUB: first entry, not compressed
+                self._writestr(epub, "mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+                self._writestr(epub, "META-INF/container.xml", CONTAINER_XML)
+
+                manifest, spine, guide, coverhash = self._load_cover(epub, workingdir, previous, metadata)
+
+                if self.incremental:
+                    chapters = self._write_chapters_incremental(epub, executor, generator, previous, metadata, manifest, spine)
+                    self._writestr(epub, METADATA_NAME, json.dumps({'version': METADATA_VERSION,
+                                                                   'epubuuid': str(epubuuid),
+                                                                   'cover': coverhash,
+                                                                   'chapters': chapters}))
+                else:
+                    # Chapters are written as soon as they are rendered
+                    with self._pipelined(generator.iter_pages('../Styles/stylesheet.css')) as pages:
+                        for _idx, chpname, html in pages:
+                            self._add_chapter(manifest, spine, chpname)
+                            self._write_chapter(epub, executor, chpname, html)
+                    self._flush_chapters(epub)
+
+                self._write_images(epub, manifest)
+
+                self._writestr(epub, "OEBPS/content.opf", CONTENT_OPF % {'title':basename, 'manifest':''.join(manifest), 'spine':''.join(spine), 'guide':guide, 'epubuuid':epubuuid})
+
+                toctxt = self._generate_toc(generator.toc)
+                self._writestr(epub, "OEBPS/toc.ncx", TOC_NCX % {'navpoints':toctxt, 'epubuuid':epubuuid})
+
+                self._writestr(epub, "OEBPS/Styles/stylesheet.css", generator.get_stylesheet())
+        except BaseException:
+            if os.path.exists(outfilename):
+                os.remove(outfilename)
+            raise
+        finally:
+            if previous:
+                previous.close()
+
+        os.replace(outfilename, epubfilename)
 
-        generator = HTMLGenerator(self.document, flat_html=False, verbose=self.verbose)
-        pages, stylesheet, toc = generator.get_html('../Styles/stylesheet.css')
+        self.timings.count('epub_bytes', os.path.getsize(epubfilename))
 
-        epub = zipfile.ZipFile(epubfilename, 'w')
-        epub.writestr("mimetype", "application/epub+zip")
-        epub.writestr("META-INF/container.xml", CONTAINER_XML)
+    def _writestr(self, epub, name, data, compress_type=None):
+        with self.timings.stage('zip_write'):
+            epub.writestr(name, data, compress_type)
+        self.timings.count('zip_entries')
 
-        manifest, spine, guide = self._load_cover(epub, workingdir)
+    def _write_chapter(self, epub, executor, chpname, html):
+        '''Write a chapter, deflating it in the executor while the next ones are rendered'''
+        name = f"OEBPS/Text/{chpname}"
+        if executor is None:
+            self._writestr(epub, name, html)
+            return
 
-        for _idx, chpname, html in pages:
-            manifest += f'    <item id="{chpname}" href="Text/{chpname}" media-type="application/xhtml+xml"/>'
-            spine += f'    <itemref idref="{chpname}"/>\n'
-            epub.writestr(f"OEBPS/Text/{chpname}", html)
+        data = html.encode('utf-8')
+        self._pending_chapters.append((name, data, executor.submit(deflate, data, self.compresslevel)))
+        # Entries are written in order, bound the chapters held in memory
+        if len(self._pending_chapters) > 2 * self.compress_workers:
+            self._flush_chapters(epub, 2 * self.compress_workers)
 
-        epub.writestr("OEBPS/content.opf", CONTENT_OPF % {'title':basename, 'manifest':manifest, 'spine':spine, 'guide':guide, 'epubuuid':epubuuid})
+    def _flush_chapters(self, epub, keep=0):
+        while len(self._pending_chapters) > keep:
+            name, data, future = self._pending_chapters.popleft()
+            with self.timings.stage('zip_write'):
+                write_deflated_entry(epub, name, data, future.result())
+            self.timings.count('zip_entries')
 
-        toctxt = self._generate_toc(toc)
-        epub.writestr("OEBPS/toc.ncx", TOC_NCX % {'navpoints':toctxt, 'epubuuid':epubuuid})
+    def _copy_raw_entry(self, previous, epub, name, arcname=None):
+        with self.timings.stage('zip_write'):
+            copy_raw_entry(previous, epub, name, arcname)
+        self.timings.count('zip_entries')
 
-        epub.writestr("OEBPS/Styles/stylesheet.css", stylesheet)
+    def _write_images(self, epub, manifest):
+        '''Stream the embedded images from the odt, as they are compressed there.
+
+        Images with the same content share one name (see OdtParser), the
+        first image with each name is stored.
+        '''
+        images = {}
+        for image in self.document.images.values():
+            if image.embedded:
+                images.setdefault(image.name, image)
+        if not images:
+            return
+
+        with zipfile.ZipFile(self.document.odtfilename) as odtfile:
+            for idx, image in enumerate(images.values(), 1):
+                self._copy_raw_entry(odtfile, epub, image.href, f'OEBPS/Images/{image.name}')
+                manifest.append(f'    <item id="image{idx}" href="Images/{quote(image.name)}" media-type="{image.media_type}"/>\n')
+
+    def _pipelined(self, pages):
+        '''Render pages in another thread while the previous ones are written'''
+        if self.pipeline:
+            return ThreadedIterator(pages, name='odt2epub-render')
+        return closing(pages)
+
+    def _add_chapter(self, manifest, spine, chpname):
+        manifest.append(f'    <item id="{chpname}" href="Text/{chpname}" media-type="application/xhtml+xml"/>')
+        spine.append(f'    <itemref idref="{chpname}"/>\n')
+
+    def _open_previous(self, epubfilename):
+        '''Return the previous epub and its metadata, if usable for an incremental build'''
+        if not self.incremental or not os.path.isfile(epubfilename):
+            return None, None
+
+        try:
+            previous = zipfile.ZipFile(epubfilename)
+        except zipfile.BadZipFile:
+            return None, None
+
+        try:
+            metadata = json.loads(previous.read(METADATA_NAME))
+            if metadata.get('version') != METADATA_VERSION:
+                raise ValueError(metadata.get('version'))
+        except (KeyError, ValueError):
+            if self.verbose > 1:
+                print(_gt('\tprevious epub not built incrementally, rendering everything'))
+            previous.close()
+            return None, None
+
+        return previous, metadata
+
+    def _write_chapters_incremental(self, epub, executor, generator, previous, metadata, manifest, spine):
+        reusable = {}
+        if metadata:
+            for chapter in metadata['chapters']:
+                reusable[chapter['fingerprint']] = (chapter['pages'], chapter['toc'], chapter['css'])
+
+        chapters = []
+        reused = 0
+        with self._pipelined(generator.iter_chapters('../Styles/stylesheet.css', reusable)) as rendered:
+            for chapter in rendered:
+                for chpname in chapter.pagenames:
+                    self._add_chapter(manifest, spine, chpname)
+
+                if chapter.pages is None:
+                    reused += 1
+                    # Keep the entries in document order
+                    self._flush_chapters(epub)
+                    for chpname in chapter.pagenames:
+                        self._copy_raw_entry(previous, epub, f"OEBPS/Text/{chpname}")
+                else:
+                    for _idx, chpname, html in chapter.pages:
+                        self._write_chapter(epub, executor, chpname, html)
+
+                chapters.append({'fingerprint': chapter.fingerprint,
+                                 'pages': chapter.pagenames,
+                                 'toc': chapter.toc_entries,
+                                 'css': chapter.cssclasses})
+        self._flush_chapters(epub)
+
+        if self.verbose > 1:
+            print(_gt('\treused %d of %d chapters') % (reused, len(chapters)))
+
+        return chapters
 
     def _generate_toc(self, toc_root):
 
         self.playorder = 0
-        self.toctxt = ''
+        self.tocparts = []
 
         for child in toc_root.children:
             self._generate_navpoint(child)
 
-        return self.toctxt
+        return ''.join(self.tocparts)
 
     def _generate_navpoint(self, tocelement):
         self.playorder += 1
 
         indt = '  ' * tocelement.level
-        self.toctxt += f'{indt}<navPoint id="navPoint-{self.playorder}" playOrder="{self.playorder}">\n'
-        self.toctxt += f'{indt}  <navLabel><text>{tocelement.label}</text></navLabel>\n'
-        self.toctxt += f'{indt}  <content src="Text/{tocelement.pagename}#{tocelement.hid}" />\n'
+        self.tocparts.append(f'{indt}<navPoint id="navPoint-{self.playorder}" playOrder="{self.playorder}">\n'
+                             f'{indt}  <navLabel><text>{tocelement.label}</text></navLabel>\n'
+                             f'{indt}  <content src="Text/{tocelement.pagename}#{tocelement.hid}" />\n')
 
         for child in tocelement.children:
             self._generate_navpoint(child)
 
-        self.toctxt += f'{indt}</navPoint>\n'
+        self.tocparts.append(f'{indt}</navPoint>\n')
 
-    def _load_cover(self, epub, workingdir):
-        manifest = ''
-        spine = ''
+    def _load_cover(self, epub, workingdir, previous=None, metadata=None):
+        manifest = []
+        spine = []
         guide = ''
+        coverhash = None
         coverfn = os.path.join(workingdir, 'cover.jpg')
         if os.path.isfile(coverfn):
             if self.verbose > 0:
                 print('\tloading cover.jpg')
-            width, height = imagesize.get(coverfn)
-            epub.write(coverfn, arcname='/OEBPS/Images/cover.jpg')
-            epub.writestr(f"OEBPS/Text/cover.xhtml", COVER_XHTML % {'width':width, 'height':height})
-            manifest = '    <item id="cover.jpg" href="Images/cover.jpg" media-type="image/jpeg"/>\n'
-            manifest += '    <item id="cover.xhtml" href="Text/cover.xhtml" media-type="application/xhtml+xml"/>'
-            spine += '    <itemref idref="cover.xhtml"/>\n'
+            if self.incremental:
+                with open(coverfn, 'rb') as fin:
+                    coverhash = hashlib.sha256(fin.read()).hexdigest()
+
+            if previous and metadata['cover'] == coverhash:
+                self._copy_raw_entry(previous, epub, 'OEBPS/Images/cover.jpg')
+                self._copy_raw_entry(previous, epub, 'OEBPS/Text/cover.xhtml')
+            else:
+                width, height = (self.imagesizes or imagesize).get(coverfn)
+                with self.timings.stage('zip_write'):
+                    # Already compressed, deflating it again gains nothing
+                    epub.write(coverfn, arcname='/OEBPS/Images/cover.jpg', compress_type=zipfile.ZIP_STORED)
+                self.timings.count('zip_entries')
+                self._writestr(epub, f"OEBPS/Text/cover.xhtml", COVER_XHTML % {'width':width, 'height':height})
+            manifest.append('    <item id="cover.jpg" href="Images/cover.jpg" media-type="image/jpeg"/>\n')
+            manifest.append('    <item id="cover.xhtml" href="Text/cover.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append('    <itemref idref="cover.xhtml"/>\n')
             guide = '<guide>\n    <reference type="cover" title="Copertina" href="Text/cover.xhtml"/>\n  </guide>'
         else:
             if self.verbose > 2:
                 print('\tcover.jpg not found')
-        return manifest, spine, guide
+        return manifest, spine, guide, coverhash
 
 
 CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
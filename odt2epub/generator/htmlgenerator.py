@@ -16,25 +16,40 @@ along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
 
 Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
 '''
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import hashlib
+import html
 import os
+from urllib.parse import quote
 
 from odt2epub import _gt
 from odt2epub.contenthandler import Header, List
+from odt2epub.document import LazyBlocks
 from odt2epub.generator.stylesheetgenerator import StylesheetGenerator
+from odt2epub.pipeline import ThreadedIterator
+from odt2epub.timings import NULL_TIMINGS
 
 
 class HTMLGenerator:
 
-    def __init__(self, document, flat_html, verbose=0):
+    def __init__(self, document, flat_html, verbose=0, workers=1, timings=None, pipeline=False, stylesheet=None, optimize_css=False):
         self.document = document
         self.verbose = verbose
         self.flat_html = flat_html
+        # Number of processes rendering chapters concurrently (epub only)
+        self.workers = workers
+        self.timings = timings or NULL_TIMINGS
+        # Parse the blocks of a lazy document in another thread
+        self.pipeline = pipeline
+        self.stylesheet = stylesheet
+        self.optimize_css = optimize_css
 
         # self.inline_css = args.inline_css
         # self.insert_sigil_toc_id = args.insert_sigil_toc_id
         # self.insert_split_marker = args.insert_split_marker
 
-        self.htmltxt = None
+        self.htmlparts = None
         self.cssrelfilename = None
         self.current_pagename = None
         self.current_tocelement = None
@@ -44,44 +59,157 @@ class HTMLGenerator:
         self.cssclass_to_export = []
         self.note_to_export = []
         self.toc_id_counter = 0
-        self.pages = []
+        self.page_count = 0
+        self.closed_pages = []
         self.current_pagename = None
         self.toc = TocElement(None, 0, '', '', 'root')
+        self.toc_entries = []
         self.current_tocelement = self.toc
-        self.htmltxt = None
+        self.htmlparts = None
         self.cssrelfilename = None
 
     def get_html(self, cssrelfilename):
+        pages = list(self.iter_pages(cssrelfilename))
+
+        return (pages, self.get_stylesheet(), self.toc)
+
+    def iter_pages(self, cssrelfilename):
+        '''Yield (idx, pagename, html) for each page as soon as it is complete.
+
+        Only the page being rendered is kept in memory. Once exhausted,
+        get_stylesheet() and self.toc describe the whole document.
+        '''
         self._reset()
         self.cssrelfilename = cssrelfilename
 
+        if self.workers > 1 and not self.flat_html:
+            for chapter in self._iter_chapters(None):
+                yield from chapter.pages
+            return
+
+        # Time spent by the consumer between pages is not accounted
+        timings = self.timings
+        timings.start('html_generation')
+
         self._start_newpage()
 
-        self._paragraphs_to_str(self.document.paragraps)
+        with self._blocks() as blocks:
+            for paragraph in blocks:
+                self._paragraphs_to_str((paragraph,))
+                if self.closed_pages:
+                    timings.stop('html_generation')
+                    yield from self._pop_closed_pages()
+                    timings.start('html_generation')
 
         self._close_newpage()
 
-        stylesheetgenerator = StylesheetGenerator(self.document, self.cssclass_to_export, self.verbose)
-        csstxt = stylesheetgenerator.get_stylesheet()
+        timings.stop('html_generation')
+        self._count_totals()
+        yield from self._pop_closed_pages()
+
+    def iter_chapters(self, cssrelfilename, reusable=None):
+        '''Yield a Chapter for each part of the document delimited by top level pagebreaks.
+
+        reusable maps the fingerprints of chapters rendered previously to their
+        (pagenames, toc_entries, cssclasses): those chapters are not rendered
+        again and are yielded with pages set to None.
+        '''
+        self._reset()
+        self.cssrelfilename = cssrelfilename
 
-        return (self.pages, csstxt, self.toc)
+        yield from self._iter_chapters(reusable or {})
+
+    def _iter_chapters(self, reusable):
+        # Page numbers and header ids are counted upfront for every chapter,
+        # TOC entries and css classes are merged back in document order, so the
+        # output is identical to the serial rendering.
+        timings = self.timings
+        timings.start('html_generation')
+
+        jobs = []
+        page_count = 0
+        toc_id_counter = 0
+        with self._blocks() as blocks:
+            for idx, paragraps in enumerate(_split_chapters(blocks)):
+                jobs.append((paragraps, self.cssrelfilename, page_count, toc_id_counter, idx > 0))
+                page_count += _count_pagebreaks(paragraps)
+                toc_id_counter += _count_headers(paragraps)
+
+        if reusable is None:
+            # Plain parallel rendering, no need for fingerprints
+            reusable = {}
+            fingerprints = [None] * len(jobs)
+        else:
+            fingerprints = [_fingerprint_chapter(job) for job in jobs]
+        torender = [job for job, fingerprint in zip(jobs, fingerprints) if fingerprint not in reusable]
+
+        with ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else nullcontext() as executor:
+            if executor:
+                rendered = executor.map(_render_chapter, torender)
+            else:
+                rendered = map(_render_chapter, torender)
+
+            for idx, fingerprint in enumerate(fingerprints):
+                if fingerprint in reusable:
+                    pagenames, toc_entries, cssclasses = reusable[fingerprint]
+                    pages = None
+                else:
+                    result = next(rendered, None)
+                    if result is None:
+                        raise Exception(f'Something went wrong in rendering chapter {idx + 1} of {len(fingerprints)}')
+                    pages, cssclasses, toc_entries = result
+                    pagenames = [pagename for _idx, pagename, _html in pages]
+
+                self.cssclass_to_export.extend(cssclasses)
+                for toc_entry in toc_entries:
+                    self._add_toc_entry(*toc_entry)
+                self.page_count += len(pagenames)
+
+                timings.stop('html_generation')
+                yield Chapter(fingerprint, pagenames, pages, toc_entries, cssclasses)
+                timings.start('html_generation')
+
+        timings.stop('html_generation')
+        self._count_totals()
+
+    def _blocks(self):
+        '''Context manager over the top level blocks of the document'''
+        blocks = self.document.paragraps
+        if self.pipeline and isinstance(blocks, LazyBlocks):
+            return ThreadedIterator(blocks, batch_size=BLOCK_BATCH_SIZE, name='odt2epub-parse')
+        return nullcontext(blocks)
+
+    def _count_totals(self):
+        self.timings.count('pages', self.page_count)
+        self.timings.count('headers', len(self.toc_entries))
+
+    def get_stylesheet(self):
+        stylesheetgenerator = StylesheetGenerator(self.document, self.cssclass_to_export, self.verbose, self.timings, self.stylesheet,
+                                                  self.optimize_css)
+        return stylesheetgenerator.get_stylesheet()
+
+    def _pop_closed_pages(self):
+        pages = self.closed_pages
+        self.closed_pages = []
+        return pages
 
     def _start_newpage(self):
-        self.htmltxt = HTML_HEAD % f'<link href="{self.cssrelfilename}" rel="stylesheet" type="text/css" />'
+        # Page fragments, joined once in _close_newpage
+        self.htmlparts = [HTML_HEAD % f'<link href="{self.cssrelfilename}" rel="stylesheet" type="text/css" />']
 
-        idx = len(self.pages) + 1
+        idx = self.page_count + 1
         chp = f'000{idx}'[-3:]
         self.current_pagename = f'chp{chp}.xhtml'
 
     def _close_newpage(self):
 
-        self.htmltxt += self._notes_to_str()
-        self.htmltxt += HTML_TAIL
+        self.htmlparts.append(self._notes_to_str())
+        self.htmlparts.append(HTML_TAIL)
 
-        idx = len(self.pages) + 1
-        self.pages.append((idx, self.current_pagename, self.htmltxt))
+        self.page_count += 1
+        self.closed_pages.append((self.page_count, self.current_pagename, ''.join(self.htmlparts)))
 
-        self.htmltxt = None
+        self.htmlparts = None
 
     def write(self, htmlfilename):
         if self.verbose > 0:
@@ -117,31 +245,29 @@ class HTMLGenerator:
                 self._start_newpage()
 
             if isinstance(paragraph, Header):
-                line = self._header_to_str(paragraph)
+                self.htmlparts.append(self._header_to_str(paragraph))
             elif isinstance(paragraph, List):
-                line = self._list_to_str(paragraph)
+                self._list_to_str(paragraph)
             else:
-                line = self._paragraph_to_str(paragraph)
-            # print(line)
-            self.htmltxt += '%s\n' % line
-
-        return self.htmltxt
+                self.htmlparts.append(self._paragraph_to_str(paragraph))
+            self.htmlparts.append('\n')
 
     def _list_to_str(self, list_):
+        # Appends directly to the current page, items may contain pagebreaks
         if list_.list_style == 'number':
-            htmltxt = '<ol>\n'
+            self.htmlparts.append('<ol>\n')
         else:
-            htmltxt = '<ul>\n'
+            self.htmlparts.append('<ul>\n')
 
         for listitem in list_.items:
-            htmltxt += '<li>\n' + self._paragraphs_to_str(listitem.paragraps) + '</li>\n'
+            self.htmlparts.append('<li>\n')
+            self._paragraphs_to_str(listitem.paragraps)
+            self.htmlparts.append('</li>\n')
 
         if list_.list_style == 'number':
-            htmltxt += '</ol>\n'
+            self.htmlparts.append('</ol>\n')
         else:
-            htmltxt += '</ul>\n'
-
-        return htmltxt
+            self.htmlparts.append('</ul>\n')
 
     def _header_to_str(self, header):
 
@@ -154,20 +280,22 @@ class HTMLGenerator:
         hid = f'hid_{self.toc_id_counter}'
         label = self._content_to_str(header.content)
 
-        s = f'<h{level} id="{hid}">'
-        s += label
-        s += f'</h{level}>'
+        s = f'<h{level} id="{hid}">{label}</h{level}>'
 
         # Generate TOC Element
         label = label.replace('<br/>', ' ')
-        # print(level, self.current_pagename, hid, label)
+        self._add_toc_entry(level, self.current_pagename, hid, label)
+
+        return s
+
+    def _add_toc_entry(self, level, pagename, hid, label):
+        self.toc_entries.append((level, pagename, hid, label))
+        # print(level, pagename, hid, label)
         parent = self.current_tocelement.get_parent_for_level(level)
         # print(parent.label, '->', label)
-        self.current_tocelement = TocElement(parent, level, self.current_pagename, hid, label)
+        self.current_tocelement = TocElement(parent, level, pagename, hid, label)
         parent.add_child(self.current_tocelement)
 
-        return s
-
     def _paragraph_to_str(self, paragraph):
         cssclass = paragraph.get_style_display_name()
 
@@ -183,8 +311,7 @@ class HTMLGenerator:
             self.cssclass_to_export.append(cssclass)
         else:
             s = '<p>'
-        s += self._content_to_str(paragraph.content)
-        s += '</p>'
+        s = f'{s}{self._content_to_str(paragraph.content)}</p>'
         if s == '<p></p>':
             s = '<p class="emptyline">&nbsp;</p>'
 
@@ -193,52 +320,183 @@ class HTMLGenerator:
         return s
 
     def _content_to_str(self, content):
-        s = ''
+        parts = []
+        append = parts.append
         for typ, text, style in content:
             if typ == 'str':
                 if style:  # Start style
-                    if style.is_italic(True):
-                        s += '<i>'
-                    if style.is_bold():
-                        s += '<b>'
+                    italic = style.is_italic(True)
+                    bold = style.is_bold()
+                    if italic:
+                        append('<i>')
+                    if bold:
+                        append('<b>')
 
-                s += text
+                append(text)
 
                 if style:  # End style
-                    if style.is_bold():
-                        s += '</b>'
-                    if style.is_italic(True):
-                        s += '</i>'
+                    if bold:
+                        append('</b>')
+                    if italic:
+                        append('</i>')
             elif typ == 'note':
                 note = text
                 ref = note.id.replace('ftn', 'refn')
-                s += f'<sup><a id="{ref}" href="#{note.id}">{note.citation}</a></sup>'
+                append(f'<sup><a id="{ref}" href="#{note.id}">{note.citation}</a></sup>')
                 self.note_to_export.append(note)
             elif typ == 'line-break':
-                s += '<br/>'
+                append('<br/>')
+            elif typ == 'image':
+                # Flat html has no Images directory next to it
+                if text.embedded and not self.flat_html:
+                    append(_image_to_str(text))
             else:
                 raise Exception(f'Unhandled content type: {typ}')
-        return s
+        return ''.join(parts)
 
     def _notes_to_str(self):
-        s = ''
+        parts = []
 
         if len(self.note_to_export) > 0:
-            s = '<div class="notes">\n'
+            parts.append('<div class="notes">\n')
             for note in self.note_to_export:
                 ref = note.id.replace('ftn', 'refn')
-                s += f'<p class="note"><a id="{note.id}" href="#{ref}">{note.citation}</a>&nbsp;'
-                s += self._content_to_str(note.content)
-                s += '</p>\n'
-            s += '</div>'
+                parts.append(f'<p class="note"><a id="{note.id}" href="#{ref}">{note.citation}</a>&nbsp;')
+                parts.append(self._content_to_str(note.content))
+                parts.append('</p>\n')
+            parts.append('</div>')
 
         self.note_to_export.clear()
 
-        return s
+        return ''.join(parts)
+
+
+# Blocks handed over at a time from the parsing thread
+BLOCK_BATCH_SIZE = 64
+
+
+class Chapter:
+
+    __slots__ = ('fingerprint', 'pagenames', 'pages', 'toc_entries', 'cssclasses')
+
+    def __init__(self, fingerprint, pagenames, pages, toc_entries, cssclasses):
+        self.fingerprint = fingerprint
+        self.pagenames = pagenames
+        # (idx, pagename, html) or None for a reused chapter
+        self.pages = pages
+        self.toc_entries = toc_entries
+        self.cssclasses = cssclasses
+
+
+# Change whenever the rendering changes, to invalidate previous fingerprints
+# (and odt2epub.OUTPUT_VERSION, for the conversion cache)
+FINGERPRINT_VERSION = 3
+
+
+def _fingerprint_chapter(job):
+    '''Hash everything the rendering of a chapter depends on'''
+    paragraps, cssrelfilename, page_count, toc_id_counter, continued = job
+
+    digest = hashlib.sha256()
+    digest.update(repr((FINGERPRINT_VERSION, cssrelfilename, page_count, toc_id_counter, continued)).encode('utf-8'))
+    for paragraph in paragraps:
+        digest.update(repr(_paragraph_signature(paragraph)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _paragraph_signature(paragraph):
+    if isinstance(paragraph, List):
+        return ('list', paragraph.list_style,
+                [[_paragraph_signature(item) for item in listitem.paragraps] for listitem in paragraph.items])
+
+    return (type(paragraph).__name__, paragraph.get_style_display_name(), paragraph.has_pagebreak_before(),
+            _content_signature(paragraph.content))
+
+
+def _content_signature(content):
+    signature = []
+    for typ, text, style in content:
+        if typ == 'note':
+            signature.append((typ, text.id, text.citation, _content_signature(text.content)))
+        elif typ == 'image':
+            signature.append((typ, text.name, text.alt, text.width, text.height, text.embedded))
+        elif style:
+            signature.append((typ, text, style.is_italic(True), style.is_bold()))
+        else:
+            signature.append((typ, text))
+    return signature
+
+
+def _image_to_str(image):
+    size = ''
+    if image.width > 0 and image.height > 0:
+        size = f' width="{round(image.width)}" height="{round(image.height)}"'
+    return f'<img src="../Images/{quote(image.name)}" alt="{html.escape(image.alt)}"{size}/>'
+
+
+def _is_pagebreak(paragraph):
+    return not isinstance(paragraph, List) and paragraph.has_pagebreak_before()
+
+
+def _split_chapters(paragraps):
+    '''Split the top level paragraphs before every pagebreak'''
+    chapters = [[]]
+    for paragraph in paragraps:
+        if chapters[-1] and _is_pagebreak(paragraph):
+            chapters.append([])
+        chapters[-1].append(paragraph)
+    return chapters
+
+
+def _count_pagebreaks(paragraps):
+    '''Number of pages closed while rendering paragraps, see _paragraphs_to_str'''
+    count = 0
+    for paragraph in paragraps:
+        if isinstance(paragraph, List):
+            for listitem in paragraph.items:
+                count += _count_pagebreaks(listitem.paragraps)
+        elif paragraph.has_pagebreak_before():
+            count += 1
+    return count
+
+
+def _count_headers(paragraps):
+    count = 0
+    for paragraph in paragraps:
+        if isinstance(paragraph, List):
+            for listitem in paragraph.items:
+                count += _count_headers(listitem.paragraps)
+        elif isinstance(paragraph, Header):
+            count += 1
+    return count
+
+
+def _render_chapter(job):
+    '''Render one chapter, in a worker process when rendering in parallel'''
+    paragraps, cssrelfilename, page_count, toc_id_counter, continued = job
+
+    generator = HTMLGenerator(None, flat_html=False)
+    generator.cssrelfilename = cssrelfilename
+    generator.page_count = page_count
+    generator.toc_id_counter = toc_id_counter
+
+    generator._start_newpage()
+    generator._paragraphs_to_str(paragraps)
+    generator._close_newpage()
+
+    pages = generator.closed_pages
+    if continued:
+        # The first pagebreak closed the placeholder page opened above,
+        # it stands for the last page of the previous chapter
+        pages = pages[1:]
+
+    return pages, generator.cssclass_to_export, generator.toc_entries
 
 
 class TocElement():
 
+    __slots__ = ('parent', 'level', 'pagename', 'hid', 'label', 'children')
+
     def __init__(self, parent, level, pagename, hid, label):
         self.parent = parent
         self.level = int(level)
@@ -1,44 +1,52 @@
 import os
-import sys
+import re
+
+from odt2epub.timings import NULL_TIMINGS
+
+
+DEFAULT_STYLESHEET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stylesheet.css')
+
+# Parsed base stylesheets, css filename -> (mtime, size, selectors, at-rules)
+_compiled_stylesheets = {}
+
+# Values the elements have when no rule sets them (user agent stylesheet)
+_ELEMENT_DEFAULTS = {'font-style': 'normal', 'font-weight': 'normal'}
+_HEADING_DEFAULTS = {'font-style': 'normal', 'font-weight': 'bold'}
+_HEADINGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+# Selectors matching on the element or a single class: never two of them
+# match the same element with the same specificity, so they can be merged
+_SIMPLE_SELECTOR = re.compile(r'^(?:[a-z][a-z0-9]*|\.[\w-]+)$')
+
+# Comments (possibly unterminated), quoted strings, block and declaration
+# delimiters, the text between them and any other single character (a
+# slash or an unterminated quote)
+_CSS_TOKEN = re.compile(r'''/\*.*?(?:\*/|\Z)|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[{};]|[^{};"'/]+|.''', re.DOTALL)
 
 
 class StylesheetGenerator:
 
-    def __init__(self, document, cssclassToExport, verbose):
+    def __init__(self, document, cssclassToExport, verbose, timings=None, stylesheet=None, optimize=False):
         self.document = document
         self.verbose = verbose
+        self.timings = timings or NULL_TIMINGS
+        # Base stylesheet, the document styles are merged into its selectors.
+        # None, as passed on by HTMLGenerator and EpubWriter, is the bundled one
+        self.stylesheet = stylesheet or DEFAULT_STYLESHEET
+        # Drop redundant declarations, merge identical rules and minify
+        self.optimize = optimize
 
-        self._load_default_selectors()
-        self._load_document_selectors(cssclassToExport)
+        with self.timings.stage('css_generation'):
+            self._load_default_selectors()
+            self._load_document_selectors(cssclassToExport)
 
     def _load_default_selectors(self):
-        self.selectors = {}
-        basedir, __ = os.path.split(__file__)
-        cssfilename = os.path.join(basedir, 'stylesheet.css')
-        with open(cssfilename) as cssinf:
-            linenumber = 0
-            for line in cssinf:
-                linenumber += 1
-                line = line.strip()
-                if line == '':
-                    continue
-
-                if line.find('{') > 0:
-                    selector = line[:line.find('{')].strip()
-                    self.selectors[selector] = {}
-                elif line.find('}') > -1:
-                    selector = None
-                elif line.find(':') > 0:
-                    if selector is None:
-                        sys.stderr.write(f"ERROR StylesheetGenerator: line outside selector {linenumber}: {line}\n")
-                    attr = line[:line.find(':')]
-                    value = line[line.find(':') + 1:].strip()
-                    if value[-1] == ';':
-                        self.selectors[selector][attr] = value[:-1]
-                    else:
-                        sys.stderr.write(f"ERROR StylesheetGenerator: missing ending semicolon {linenumber}: {line}\n")
-                else:
-                    sys.stderr.write(f"ERROR StylesheetGenerator: unable to parse line {linenumber}: {line}\n")
+        self.selectors = load_base_selectors(self.stylesheet)
+        # Written unchanged, statements (@charset, @import) first and blocks
+        # (@font-face, @page, @media) after the rules they may override
+        at_rules = load_base_at_rules(self.stylesheet)
+        self.at_statements = [at_rule for at_rule in at_rules if not at_rule.endswith('}')]
+        self.at_blocks = [at_rule for at_rule in at_rules if at_rule.endswith('}')]
 
     def _load_document_selectors(self, docselectors):
         docselectors = sorted(set(docselectors))
@@ -63,6 +71,8 @@ class StylesheetGenerator:
                 print('StylesheetGenerator:', 'default properties:', properties)
 
             for property_, value in style.get_css_properties():
+                if self.optimize and property_ not in properties and self._is_default(selector, property_, value):
+                    continue
                 properties[property_] = value
 
             if self.verbose > 1:
@@ -71,16 +81,172 @@ class StylesheetGenerator:
             self.selectors[selector] = properties
 
     def get_stylesheet(self):
-        csstxt = ''
+        with self.timings.stage('css_generation'):
+            csstxt = self._get_stylesheet()
+        self.timings.count('css_selectors', len(self.selectors))
+        return csstxt
+
+    def _is_default(self, selector, property_, value):
+        '''True if the selected elements get value for property_ without a declaration'''
+        if selector in _HEADINGS:
+            return _HEADING_DEFAULTS.get(property_) == value
+
+        if not selector.startswith('.'):
+            return False
+
+        # Classes are only set on paragraphs, which inherit from body and html
+        for element in ('p', 'body', 'html'):
+            rule = self.selectors.get(element, {})
+            if property_ in rule:
+                return rule[property_] == value
+        return _ELEMENT_DEFAULTS.get(property_) == value
+
+    def _get_stylesheet(self):
+        if self.optimize:
+            return self._get_optimized_stylesheet()
 
+        parts = [f'{at_rule}\n\n' for at_rule in self.at_statements]
         for selector in sorted(self.selectors, key=_key_selector):
             properties = self.selectors[selector]
-            csstxt += f'{selector} {{\n'
+            parts.append(f'{selector} {{\n')
             for property_, value in sorted(properties.items()):
-                csstxt += f'  {property_}: {value};\n'
-            csstxt += '}\n\n'
+                parts.append(f'  {property_}: {value};\n')
+            parts.append('}\n\n')
+        parts.extend(f'{at_rule}\n\n' for at_rule in self.at_blocks)
 
-        return csstxt
+        return ''.join(parts)
+
+    def _get_optimized_stylesheet(self):
+        # Rules in output order, simple selectors with the same declarations
+        # grouped in the rule of the first one
+        rules = []
+        grouped = {}
+        for selector in sorted(self.selectors, key=_key_selector):
+            declarations = ';'.join(f'{property_}:{value}' for property_, value in sorted(self.selectors[selector].items()))
+            if not declarations:
+                continue
+            if _SIMPLE_SELECTOR.match(selector):
+                if declarations in grouped:
+                    grouped[declarations].append(selector)
+                    continue
+                grouped[declarations] = [selector]
+                rules.append((grouped[declarations], declarations))
+            else:
+                rules.append(([selector], declarations))
+
+        return ''.join(self.at_statements
+                       + [f'{",".join(selectors)}{{{declarations}}}' for selectors, declarations in rules]
+                       + self.at_blocks)
+
+
+def load_base_selectors(cssfilename=DEFAULT_STYLESHEET):
+    '''Return a copy of the selectors of a base stylesheet.
+
+    The file is parsed once per process, and again only when its
+    modification time or size change.
+    '''
+    selectors = _compile_stylesheet(cssfilename)[2]
+    return {selector: dict(properties) for selector, properties in selectors.items()}
+
+
+def load_base_at_rules(cssfilename=DEFAULT_STYLESHEET):
+    '''Return the at-rules of a base stylesheet, as written in the file'''
+    return _compile_stylesheet(cssfilename)[3]
+
+
+def _compile_stylesheet(cssfilename):
+    cssfilename = os.path.abspath(cssfilename)
+    stat = os.stat(cssfilename)
+    compiled = _compiled_stylesheets.get(cssfilename)
+    if compiled is None or compiled[:2] != (stat.st_mtime_ns, stat.st_size):
+        compiled = (stat.st_mtime_ns, stat.st_size, *_parse_stylesheet(cssfilename))
+        _compiled_stylesheets[cssfilename] = compiled
+    return compiled
+
+
+def _parse_stylesheet(cssfilename):
+    '''Return (selector -> {property: value}, at-rules) of a stylesheet.
+
+    Comments are dropped and declarations may share a line with their
+    selector. At-rules are kept as written, in a tuple. Nested blocks in
+    plain rules and malformed declarations raise.
+    '''
+    with open(cssfilename, encoding='utf-8') as cssinf:
+        css = cssinf.read()
+
+    def error(message, position):
+        linenumber = css.count('\n', 0, position) + 1
+        raise Exception(f'{cssfilename}:{linenumber}: {message}')
+
+    selectors = {}
+    at_rules = []
+    # Nesting depth inside an at-rule block
+    at_depth = 0
+    properties = None
+    text = ''
+    text_position = 0
+    for match in _CSS_TOKEN.finditer(css):
+        token = match.group()
+        if token.startswith('/*'):
+            if not token.endswith('*/') or len(token) < 4:
+                error('unterminated comment', match.start())
+            continue
+        if token in ('"', "'"):
+            error('unterminated string', match.start())
+
+        if at_depth:
+            if token == '{':
+                at_depth += 1
+            elif token == '}':
+                at_depth -= 1
+                if not at_depth:
+                    at_rules.append(css[text_position:match.end()].strip())
+                    text = ''
+            continue
+
+        if token not in '{};':
+            if not text.strip():
+                text_position = match.start()
+            text += token
+            continue
+
+        if token == '{':
+            selector = text.strip()
+            if properties is not None:
+                error('nested blocks are not supported', match.start())
+            if not selector:
+                error('missing selector', match.start())
+            if selector.startswith('@'):
+                at_depth = 1
+                continue
+            properties = selectors.setdefault(selector, {})
+        else:
+            declaration = text.strip()
+            if properties is None:
+                if token == '}':
+                    error("unexpected '}'", match.start())
+                if declaration.startswith('@'):
+                    at_rules.append(css[text_position:match.end()].strip())
+                elif declaration:
+                    error(f'declaration outside selector: {declaration}', text_position)
+            elif declaration:
+                name, colon, value = declaration.partition(':')
+                name, value = name.strip(), value.strip()
+                if not colon or not name:
+                    error(f'malformed declaration: {declaration}', text_position)
+                if not value:
+                    error(f'empty value for {name}', text_position)
+                properties[name] = value
+            if token == '}':
+                properties = None
+        text = ''
+
+    if properties is not None or at_depth:
+        error("missing '}' at end of file", len(css))
+    if text.strip():
+        error(f'unexpected text at end of file: {text.strip()}', text_position)
+
+    return selectors, tuple(at_rules)
 
 
 # https://blogboard.io/blog/knowledge/python-sorted-lambda/
@@ -0,0 +1,119 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+import copy
+import struct
+import time
+import zipfile
+import zlib
+
+_CHUNK_SIZE = 64 * 1024
+
+# CPython internals used to write entries as compressed bytes. They are not
+# part of the zipfile API: when missing, the entries are written with
+# writestr(), inflating or deflating them again.
+_MODULE_INTERNALS = ('_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH', 'structFileHeader', 'sizeFileHeader',
+                     'stringFileHeader')
+_ZIPFILE_INTERNALS = ('fp', '_lock', '_writecheck', '_didModify', 'start_dir', 'filelist', 'NameToInfo')
+
+
+def _has_internals(*zfiles):
+    return (all(hasattr(zipfile, name) for name in _MODULE_INTERNALS)
+            and all(hasattr(zfile, name) for zfile in zfiles for name in _ZIPFILE_INTERNALS))
+
+
+def copy_raw_entry(source, target, name, arcname=None):
+    '''Copy an entry between two open ZipFile, as compressed bytes.
+
+    The data is neither inflated nor deflated again: the local header is
+    rebuilt from the source ZipInfo and the compressed payload copied as is.
+    zipfile has no public API for this, hence the use of its internals.
+    arcname renames the entry in target.
+    '''
+    info = source.getinfo(name)
+    if not _has_internals(source, target):
+        newinfo = zipfile.ZipInfo(arcname or name, date_time=info.date_time)
+        newinfo.compress_type = info.compress_type
+        newinfo.external_attr = info.external_attr
+        target.writestr(newinfo, source.read(name))
+        return
+
+    source.fp.seek(info.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader))
+    if fheader[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f'Bad magic number for file header of {name}')
+    source.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    newinfo = copy.copy(info)
+    # Sizes and CRC go in the local header, no data descriptor is copied
+    newinfo.flag_bits &= ~0x08
+    newinfo.extra = b''
+    if arcname:
+        newinfo.filename = newinfo.orig_filename = arcname
+
+    def chunks():
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = source.fp.read(min(_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f'Truncated data for {name}')
+            yield chunk
+            remaining -= len(chunk)
+
+    _write_raw_entry(target, newinfo, chunks())
+
+
+def deflate(data, compresslevel):
+    '''Raw deflate stream of data, as stored in a zip entry.
+
+    zlib releases the GIL while compressing, so several entries can be
+    deflated at once in a thread pool and then added by write_deflated_entry.
+    '''
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def write_deflated_entry(target, name, data, compressed):
+    '''Add to an open ZipFile an entry whose data has already been deflated'''
+    info = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    info.file_size = len(data)
+    info.compress_size = len(compressed)
+    info.CRC = zlib.crc32(data)
+
+    if not _has_internals(target):
+        target.writestr(info, data)
+        return
+    _write_raw_entry(target, info, (compressed,))
+
+
+def _write_raw_entry(target, info, chunks):
+    '''Write the local header of info, then the already compressed chunks'''
+    with target._lock:
+        target._writecheck(info)
+        target._didModify = True
+        info.header_offset = target.fp.tell()
+        target.fp.write(info.FileHeader(info.file_size > zipfile.ZIP64_LIMIT))
+
+        for chunk in chunks:
+            target.fp.write(chunk)
+
+        target.start_dir = target.fp.tell()
+        target.filelist.append(info)
+        target.NameToInfo[info.filename] = info
@@ -21,8 +21,6 @@
 # WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH
 # THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
-import io
-import os
 import re
 import struct
 
@@ -102,190 +100,257 @@ def _convertToPx(value):
     raise ValueError("unknown unit type: %s" % unit)
 
 
-def get(filepath):
+# Bytes read at once from a file or a stream, enough for most headers
+PROBE_SIZE = 4096
+
+
+class _Source:
     """
-    Return (width, height) for a given img file content
-    no requirements
-    :type filepath: Union[bytes, str, pathlib.Path]
-    :rtype Tuple[int, int]
+    Random access to the head of an image, parsed in place.
+
+    bytes-like objects are used as they are, without copies. Files and
+    streams are read into one bounded buffer, grown when a header runs past
+    it; a window far past the buffer is read on its own if the stream can
+    seek.
     """
-    height = -1
-    width = -1
 
-    if isinstance(filepath, io.BytesIO):  # file-like object
-        fhandle = filepath
-    else:
-        fhandle = open(filepath, 'rb')
-
-    try:
-        head = fhandle.read(31)
-        size = len(head)
-        # handle GIFs
-        if size >= 10 and head[:6] in (b'GIF87a', b'GIF89a'):
-            # Check to see if content_type is correct
-            try:
-                width, height = struct.unpack("<hh", head[6:10])
-            except struct.error:
-                raise ValueError("Invalid GIF file")
-        # see png edition spec bytes are below chunk length then and finally the
-        elif size >= 24 and head.startswith(b'\211PNG\r\n\032\n') and head[12:16] == b'IHDR':
-            try:
-                width, height = struct.unpack(">LL", head[16:24])
-            except struct.error:
-                raise ValueError("Invalid PNG file")
-        # Maybe this is for an older PNG version.
-        elif size >= 16 and head.startswith(b'\211PNG\r\n\032\n'):
-            # Check to see if we have the right content type
-            try:
-                width, height = struct.unpack(">LL", head[8:16])
-            except struct.error:
-                raise ValueError("Invalid PNG file")
-        # handle JPEGs
-        elif size >= 2 and head.startswith(b'\377\330'):
-            try:
-                fhandle.seek(0)  # Read 0xff next
-                size = 2
-                ftype = 0
-                while not 0xc0 <= ftype <= 0xcf or ftype in [0xc4, 0xc8, 0xcc]:
-                    fhandle.seek(size, 1)
-                    byte = fhandle.read(1)
-                    while ord(byte) == 0xff:
-                        byte = fhandle.read(1)
-                    ftype = ord(byte)
-                    size = struct.unpack('>H', fhandle.read(2))[0] - 2
-                # We are at a SOFn block
-                fhandle.seek(1, 1)  # Skip `precision' byte.
-                height, width = struct.unpack('>HH', fhandle.read(4))
-            except (struct.error, TypeError):
-                raise ValueError("Invalid JPEG file")
-        # handle JPEG2000s
-        elif size >= 12 and head.startswith(b'\x00\x00\x00\x0cjP  \r\n\x87\n'):
-            fhandle.seek(48)
-            try:
-                height, width = struct.unpack('>LL', fhandle.read(8))
-            except struct.error:
-                raise ValueError("Invalid JPEG2000 file")
-        # handle big endian TIFF
-        elif size >= 8 and head.startswith(b"\x4d\x4d\x00\x2a"):
-            offset = struct.unpack('>L', head[4:8])[0]
-            fhandle.seek(offset)
-            ifdsize = struct.unpack(">H", fhandle.read(2))[0]
-            for i in range(ifdsize):
-                tag, datatype, count, data = struct.unpack(">HHLL", fhandle.read(12))
-                if tag == 256:
-                    if datatype == 3:
-                        width = int(data / 65536)
-                    elif datatype == 4:
-                        width = data
-                    else:
-                        raise ValueError("Invalid TIFF file: width column data type should be SHORT/LONG.")
-                elif tag == 257:
-                    if datatype == 3:
-                        height = int(data / 65536)
-                    elif datatype == 4:
-                        height = data
-                    else:
-                        raise ValueError("Invalid TIFF file: height column data type should be SHORT/LONG.")
-                if width != -1 and height != -1:
-                    break
-            if width == -1 or height == -1:
-                raise ValueError("Invalid TIFF file: width and/or height IDS entries are missing.")
-        elif size >= 8 and head.startswith(b"\x49\x49\x2a\x00"):
-            offset = struct.unpack('<L', head[4:8])[0]
-            fhandle.seek(offset)
-            ifdsize = struct.unpack("<H", fhandle.read(2))[0]
-            for i in range(ifdsize):
-                tag, datatype, count, data = struct.unpack("<HHLL", fhandle.read(12))
-                if tag == 256:
-                    width = data
-                elif tag == 257:
-                    height = data
-                if width != -1 and height != -1:
-                    break
-            if width == -1 or height == -1:
-                raise ValueError("Invalid TIFF file: width and/or height IDS entries are missing.")
-        # handle little endian BigTiff
-        elif size >= 8 and head.startswith(b"\x49\x49\x2b\x00"):
-            bytesize_offset = struct.unpack('<L', head[4:8])[0]
-            if bytesize_offset != 8:
-                raise ValueError('Invalid BigTIFF file: Expected offset to be 8, found {} instead.'.format(offset))
-            offset = struct.unpack('<Q', head[8:16])[0]
-            fhandle.seek(offset)
-            ifdsize = struct.unpack("<Q", fhandle.read(8))[0]
-            for i in range(ifdsize):
-                tag, datatype, count, data = struct.unpack("<HHQQ", fhandle.read(20))
-                if tag == 256:
-                    width = data
-                elif tag == 257:
-                    height = data
-                if width != -1 and height != -1:
-                    break
-            if width == -1 or height == -1:
-                raise ValueError("Invalid BigTIFF file: width and/or height IDS entries are missing.")
-
-        # handle SVGs
-        elif size >= 5 and (head.startswith(b'<?xml') or head.startswith(b'<svg')):
-            fhandle.seek(0)
-            data = fhandle.read(1024)
-            try:
-                data = data.decode('utf-8')
-                width = re.search(r'[^-]width="(.*?)"', data).group(1)
-                height = re.search(r'[^-]height="(.*?)"', data).group(1)
-            except Exception:
-                raise ValueError("Invalid SVG file")
-            width = _convertToPx(width)
-            height = _convertToPx(height)
-
-        # handle Netpbm
-        elif head[:1] == b"P" and head[1:2] in b"123456":
-            fhandle.seek(2)
-            sizes = []
+    def __init__(self, data=None, stream=None):
+        self._stream = stream
+        if stream is None:
+            if isinstance(data, memoryview) and (data.ndim != 1 or data.itemsize != 1):
+                data = data.cast('B')
+            self.data = data
+            self._eof = True
+        else:
+            # Offset of the image in stream, False if it cannot seek, found on demand
+            self._start = None
+            # Position of stream, relative to the image
+            self._pos = 0
+            self.data = b''
+            self._eof = False
+            self._fill(PROBE_SIZE)
 
-            while True:
-                next_chr = fhandle.read(1)
+    def _can_seek(self):
+        if self._start is None:
+            seekable = getattr(self._stream, 'seekable', None)
+            self._start = self._stream.tell() - self._pos if seekable and seekable() else False
+        return self._start is not False
 
-                if next_chr.isspace():
-                    continue
+    def _fill(self, size):
+        if self._pos != len(self.data):
+            self._stream.seek(self._start + len(self.data))
+        chunks = [self.data] if self.data else []
+        missing = size - len(self.data)
+        while missing > 0:
+            chunk = self._stream.read(missing)
+            if not chunk:
+                self._eof = True
+                break
+            chunks.append(chunk)
+            missing -= len(chunk)
+        self.data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+        self._pos = len(self.data)
 
-                if next_chr == b"":
-                    raise ValueError("Invalid Netpbm file")
+    def window(self, offset, size):
+        """
+        Return (buffer, base), buffer holding the size bytes from offset at
+        offset - base, fewer at the end of the data.
+        """
+        end = offset + size
+        if end > len(self.data) and not self._eof:
+            if offset > 2 * len(self.data) and self._can_seek():
+                self._stream.seek(self._start + offset)
+                buffer = self._stream.read(max(size, PROBE_SIZE))
+                self._pos = offset + len(buffer)
+                return buffer, offset
+            self._fill(max(end, 2 * len(self.data)))
+        return self.data, 0
 
-                if next_chr == b"#":
-                    fhandle.readline()
-                    continue
+    def view(self, offset, size):
+        buffer, base = self.window(offset, size)
+        return memoryview(buffer)[offset - base:offset - base + size]
 
-                if not next_chr.isdigit():
-                    raise ValueError("Invalid character found on Netpbm file")
+    def unpack(self, fmt, offset):
+        buffer, base = self.window(offset, struct.calcsize(fmt))
+        return struct.unpack_from(fmt, buffer, offset - base)
 
-                size = next_chr
-                next_chr = fhandle.read(1)
 
-                while next_chr.isdigit():
-                    size += next_chr
-                    next_chr = fhandle.read(1)
+def _probe(source, function):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return function(_Source(source))
+    if hasattr(source, 'read'):
+        return function(_Source(stream=source))
+    with open(source, 'rb', buffering=0) as fhandle:
+        return function(_Source(stream=fhandle))
 
-                sizes.append(int(size))
 
-                if len(sizes) == 2:
-                    break
+_JPEG_MARKER = struct.Struct('>BBH')
+
+
+# SOFn markers, holding the size of the image
+_JPEG_SOF = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+# APP0 holds the density, if any, before the first SOFn
+_JPEG_DPI_END = frozenset(range(0xc0, 0xd0)) | {0xe0}
+
 
-                fhandle.seek(-1, os.SEEK_CUR)
-            width, height = sizes
-        elif head.startswith(b"RIFF") and head[8:12] == b"WEBP":
-            if head[12:16] == b"VP8 ":
-                width, height = struct.unpack("<HH", head[26:30])
-            elif head[12:16] == b"VP8X":
-                width = struct.unpack("<I", head[24:27] + b"\0")[0]
-                height = struct.unpack("<I", head[27:30] + b"\0")[0]
-            elif head[12:16] == b"VP8L":
-                b = head[21:25]
-                width = (((b[1] & 63) << 8) | b[0]) + 1
-                height = (((b[3] & 15) << 10) | (b[2] << 2) | ((b[1] & 192) >> 6)) + 1
+def _jpeg_find(source, markers):
+    """Return (marker, offset of its data) of the first JPEG segment in markers"""
+    buffer, base = source.data, 0
+    offset = 2
+    unpack_from = _JPEG_MARKER.unpack_from
+    while True:
+        if offset - base + 4 > len(buffer):
+            buffer, base = source.window(offset, 4)
+        try:
+            fill, marker, size = unpack_from(buffer, offset - base)
+        except struct.error:
+            raise ValueError("Invalid JPEG file")
+        if fill != 0xff:
+            raise ValueError("Invalid JPEG file")
+        if marker == 0xff:  # fill byte
+            offset += 1
+        elif marker in markers:
+            return marker, offset + 4
+        else:
+            offset += 2 + size
+
+
+def _tiff_size(source, offset, fmt, countFmt, shortDatatype):
+    width = -1
+    height = -1
+    ifdsize, = source.unpack(countFmt, offset)
+    offset += struct.calcsize(countFmt)
+    entrySize = struct.calcsize(fmt)
+    for i in range(ifdsize):
+        tag, datatype, count, data = source.unpack(fmt, offset + i * entrySize)
+        if tag == 256 or tag == 257:
+            if shortDatatype and datatype == 3:
+                data = int(data / 65536)
+            elif shortDatatype and datatype != 4:
+                raise ValueError("Invalid TIFF file: %s column data type should be SHORT/LONG." %
+                                 ('width' if tag == 256 else 'height'))
+            if tag == 256:
+                width = data
             else:
-                raise ValueError("Unsupported WebP file")
+                height = data
+        if width != -1 and height != -1:
+            break
+    return width, height
 
-    finally:
-        fhandle.close()
+
+_NETPBM_SIZE = re.compile(rb'(?:\s|#[^\n]*\n)*(\d+)(?:\s|#[^\n]*\n)+(\d+)')
+
+
+def get(filepath):
+    """
+    Return (width, height) for a given img file content
+    no requirements
+    :type filepath: Union[str, pathlib.Path, bytes, bytearray, memoryview, BinaryIO]
+    :rtype Tuple[int, int]
+
+    A path is opened and read, bytes-like objects are the image data itself
+    and a stream (e.g. zipfile.ZipExtFile) is read from its current position
+    and left open. Only the header is read, in one buffer of PROBE_SIZE bytes
+    when it fits.
+    """
+    return _probe(filepath, _get)
+
+
+def _get(source):
+    height = -1
+    width = -1
+
+    # data holds at least PROBE_SIZE bytes, unless the image is shorter
+    head = bytes(source.data[:32])
+    size = len(head)
+    # handle GIFs
+    if size >= 10 and head[:6] in (b'GIF87a', b'GIF89a'):
+        width, height = struct.unpack_from("<HH", head, 6)
+    # see png edition spec bytes are below chunk length then and finally the
+    elif size >= 24 and head.startswith(b'\211PNG\r\n\032\n') and head[12:16] == b'IHDR':
+        width, height = struct.unpack_from(">LL", head, 16)
+    # Maybe this is for an older PNG version.
+    elif size >= 16 and head.startswith(b'\211PNG\r\n\032\n'):
+        width, height = struct.unpack_from(">LL", head, 8)
+    # handle JPEGs
+    elif size >= 2 and head.startswith(b'\377\330'):
+        __, offset = _jpeg_find(source, _JPEG_SOF)
+        try:
+            # We are at a SOFn block, skip the `precision' byte
+            height, width = source.unpack('>HH', offset + 1)
+        except struct.error:
+            raise ValueError("Invalid JPEG file")
+    # handle JPEG2000s
+    elif size >= 12 and head.startswith(b'\x00\x00\x00\x0cjP  \r\n\x87\n'):
+        try:
+            height, width = source.unpack('>LL', 48)
+        except struct.error:
+            raise ValueError("Invalid JPEG2000 file")
+    # handle big endian TIFF
+    elif size >= 8 and head.startswith(b"\x4d\x4d\x00\x2a"):
+        try:
+            width, height = _tiff_size(source, struct.unpack_from('>L', head, 4)[0], '>HHLL', '>H', True)
+        except struct.error:
+            raise ValueError("Invalid TIFF file")
+        if width == -1 or height == -1:
+            raise ValueError("Invalid TIFF file: width and/or height IDS entries are missing.")
+    elif size >= 8 and head.startswith(b"\x49\x49\x2a\x00"):
+        try:
+            width, height = _tiff_size(source, struct.unpack_from('<L', head, 4)[0], '<HHLL', '<H', False)
+        except struct.error:
+            raise ValueError("Invalid TIFF file")
+        if width == -1 or height == -1:
+            raise ValueError("Invalid TIFF file: width and/or height IDS entries are missing.")
+    # handle little endian BigTiff
+    elif size >= 8 and head.startswith(b"\x49\x49\x2b\x00"):
+        bytesize_offset = struct.unpack_from('<L', head, 4)[0]
+        if bytesize_offset != 8:
+            raise ValueError('Invalid BigTIFF file: Expected offset to be 8, found {} instead.'.format(bytesize_offset))
+        try:
+            width, height = _tiff_size(source, struct.unpack_from('<Q', head, 8)[0], '<HHQQ', '<Q', False)
+        except struct.error:
+            raise ValueError("Invalid BigTIFF file")
+        if width == -1 or height == -1:
+            raise ValueError("Invalid BigTIFF file: width and/or height IDS entries are missing.")
+
+    # handle SVGs
+    elif size >= 5 and (head.startswith(b'<?xml') or head.startswith(b'<svg')):
+        try:
+            data = bytes(source.view(0, 1024)).decode('utf-8')
+            width = re.search(r'[^-]width="(.*?)"', data).group(1)
+            height = re.search(r'[^-]height="(.*?)"', data).group(1)
+        except Exception:
+            raise ValueError("Invalid SVG file")
+        width = _convertToPx(width)
+        height = _convertToPx(height)
+
+    # handle Netpbm
+    elif head[:1] == b"P" and head[1:2] in b"123456":
+        window = 1024
+        while True:
+            data = bytes(source.view(2, window))
+            matched = _NETPBM_SIZE.match(data)
+            # The second size may go on past the window
+            if matched and matched.end() < len(data):
+                break
+            if len(data) < window:
+                if not matched:
+                    raise ValueError("Invalid Netpbm file")
+                break
+            window *= 2
+        width, height = int(matched.group(1)), int(matched.group(2))
+    elif head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        if head[12:16] == b"VP8 ":
+            width, height = struct.unpack("<HH", head[26:30])
+        elif head[12:16] == b"VP8X":
+            width = struct.unpack("<I", head[24:27] + b"\0")[0]
+            height = struct.unpack("<I", head[27:30] + b"\0")[0]
+        elif head[12:16] == b"VP8L":
+            b = head[21:25]
+            width = (((b[1] & 63) << 8) | b[0]) + 1
+            height = (((b[3] & 15) << 10) | (b[2] << 2) | ((b[1] & 192) >> 6)) + 1
+        else:
+            raise ValueError("Unsupported WebP file")
 
     return width, height
 
@@ -294,33 +359,32 @@ def getDPI(filepath):
     """
     Return (x DPI, y DPI) for a given img file content
     no requirements
-    :type filepath: Union[bytes, str, pathlib.Path]
+    :type filepath: Union[str, pathlib.Path, bytes, bytearray, memoryview, BinaryIO]
     :rtype Tuple[int, int]
+
+    Accepts the same sources as get.
     """
+    return _probe(filepath, _getDPI)
+
+
+def _getDPI(source):
     xDPI = -1
     yDPI = -1
 
-    if not isinstance(filepath, bytes):
-        filepath = str(filepath)
-
-    with open(filepath, 'rb') as fhandle:
-        head = fhandle.read(24)
-        size = len(head)
-        # handle GIFs
-        # GIFs doesn't have density
-        if size >= 10 and head[:6] in (b'GIF87a', b'GIF89a'):
-            pass
-        # see png edition spec bytes are below chunk length then and finally the
-        elif size >= 24 and head.startswith(b'\211PNG\r\n\032\n'):
-            chunkOffset = 8
-            chunk = head[8:]
+    head = bytes(source.data[:24])
+    size = len(head)
+    # handle GIFs
+    # GIFs doesn't have density
+    if size >= 10 and head[:6] in (b'GIF87a', b'GIF89a'):
+        pass
+    # see png edition spec bytes are below chunk length then and finally the
+    elif size >= 24 and head.startswith(b'\211PNG\r\n\032\n'):
+        chunkOffset = 8
+        try:
             while True:
-                chunkType = chunk[4:8]
+                dataSize, chunkType = source.unpack(">L4s", chunkOffset)
                 if chunkType == b'pHYs':
-                    try:
-                        xDensity, yDensity, unit = struct.unpack(">LLB", chunk[8:])
-                    except struct.error:
-                        raise ValueError("Invalid PNG file")
+                    xDensity, yDensity, unit = source.unpack(">LLB", chunkOffset + 8)
                     if unit:
                         xDPI = _convertToDPI(xDensity, _UNIT_1M)
                         yDPI = _convertToDPI(yDensity, _UNIT_1M)
@@ -330,69 +394,54 @@ def getDPI(filepath):
                     break
                 elif chunkType == b'IDAT':
                     break
-                else:
-                    try:
-                        dataSize, = struct.unpack(">L", chunk[0:4])
-                    except struct.error:
-                        raise ValueError("Invalid PNG file")
-                    chunkOffset += dataSize + 12
-                    fhandle.seek(chunkOffset)
-                    chunk = fhandle.read(17)
-        # handle JPEGs
-        elif size >= 2 and head.startswith(b'\377\330'):
-            try:
-                fhandle.seek(0)  # Read 0xff next
-                size = 2
-                ftype = 0
-                while not 0xc0 <= ftype <= 0xcf:
-                    if ftype == 0xe0:  # APP0 marker
-                        fhandle.seek(7, 1)
-                        unit, xDensity, yDensity = struct.unpack(">BHH", fhandle.read(5))
-                        if unit == 1 or unit == 0:
-                            xDPI = xDensity
-                            yDPI = yDensity
-                        elif unit == 2:
-                            xDPI = _convertToDPI(xDensity, _UNIT_CM)
-                            yDPI = _convertToDPI(yDensity, _UNIT_CM)
-                        break
-                    fhandle.seek(size, 1)
-                    byte = fhandle.read(1)
-                    while ord(byte) == 0xff:
-                        byte = fhandle.read(1)
-                    ftype = ord(byte)
-                    size = struct.unpack('>H', fhandle.read(2))[0] - 2
-            except struct.error:
-                raise ValueError("Invalid JPEG file")
-        # handle JPEG2000s
-        elif size >= 12 and head.startswith(b'\x00\x00\x00\x0cjP  \r\n\x87\n'):
-            fhandle.seek(32)
+                chunkOffset += dataSize + 12
+        except struct.error:
+            raise ValueError("Invalid PNG file")
+    # handle JPEGs
+    elif size >= 2 and head.startswith(b'\377\330'):
+        marker, offset = _jpeg_find(source, _JPEG_DPI_END)
+        try:
+            if marker == 0xe0:  # APP0 marker
+                unit, xDensity, yDensity = source.unpack(">BHH", offset + 7)
+                if unit == 1 or unit == 0:
+                    xDPI = xDensity
+                    yDPI = yDensity
+                elif unit == 2:
+                    xDPI = _convertToDPI(xDensity, _UNIT_CM)
+                    yDPI = _convertToDPI(yDensity, _UNIT_CM)
+        except struct.error:
+            raise ValueError("Invalid JPEG file")
+    # handle JPEG2000s
+    elif size >= 12 and head.startswith(b'\x00\x00\x00\x0cjP  \r\n\x87\n'):
+        try:
             # skip JP2 image header box
-            headerSize = struct.unpack('>L', fhandle.read(4))[0] - 8
-            fhandle.seek(4, 1)
+            headerSize = source.unpack('>L', 32)[0] - 8
+            offset = 40
             foundResBox = False
-            try:
+            while headerSize > 0:
+                boxSize, boxType = source.unpack('>L4s', offset)
+                offset += 8
+                if boxSize < 8:
+                    raise ValueError("Invalid JPEG2000 file")
+                if boxType == b'res ':  # find resolution super box
+                    foundResBox = True
+                    headerSize -= 8
+                    break
+                offset += boxSize - 8
+                headerSize -= boxSize
+            if foundResBox:
                 while headerSize > 0:
-                    boxHeader = fhandle.read(8)
-                    boxType = boxHeader[4:]
-                    if boxType == b'res ':  # find resolution super box
-                        foundResBox = True
-                        headerSize -= 8
+                    boxSize, boxType = source.unpack('>L4s', offset)
+                    offset += 8
+                    if boxSize < 8:
+                        raise ValueError("Invalid JPEG2000 file")
+                    if boxType == b'resd':  # Display resolution box
+                        yDensity, xDensity, yUnit, xUnit = source.unpack(">HHBB", offset)
+                        xDPI = _convertToDPI(xDensity, xUnit)
+                        yDPI = _convertToDPI(yDensity, yUnit)
                         break
-                    boxSize, = struct.unpack('>L', boxHeader[:4])
-                    fhandle.seek(boxSize - 8, 1)
+                    offset += boxSize - 8
                     headerSize -= boxSize
-                if foundResBox:
-                    while headerSize > 0:
-                        boxHeader = fhandle.read(8)
-                        boxType = boxHeader[4:]
-                        if boxType == b'resd':  # Display resolution box
-                            yDensity, xDensity, yUnit, xUnit = struct.unpack(">HHBB", fhandle.read(10))
-                            xDPI = _convertToDPI(xDensity, xUnit)
-                            yDPI = _convertToDPI(yDensity, yUnit)
-                            break
-                        boxSize, = struct.unpack('>L', boxHeader[:4])
-                        fhandle.seek(boxSize - 8, 1)
-                        headerSize -= boxSize
-            except struct.error as e:
-                raise ValueError("Invalid JPEG2000 file")
+        except struct.error:
+            raise ValueError("Invalid JPEG2000 file")
     return xDPI, yDPI
@@ -16,34 +16,251 @@ along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
 
 Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
 '''
-from io import BytesIO
-from xml.sax import parse
+from itertools import islice
+from xml.sax import make_parser
+import xml.sax.handler
 import zipfile
 
-from odt2epub import _gt
+from odt2epub import _gt, imagesize
 from odt2epub.stylehandler import StyleHandler
 from odt2epub.contenthandler import ContentHandler
-from odt2epub.document import Document
+from odt2epub.dispatchhandler import DispatchHandler
+from odt2epub.expatreader import ExpatReader
+from odt2epub.document import Document, LazyDocument
+from odt2epub.diagnostics import Diagnostics
+from odt2epub.timings import NULL_TIMINGS
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+BACKENDS = ('sax', 'expat')
+
+# Image types every epub reader has to support
+EPUB_IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/svg+xml')
+
+MISSING_IMAGE = 'image missing from the odt (skipped)'
+UNSUPPORTED_IMAGE = 'image type not supported by epub (skipped)'
 
 
 class OdtParser:
 
-    def __init__(self):
-        pass
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, timings=None, backend='sax', imagesizes=None):
+        '''
+        chunk_size: number of bytes fed to the parser at a time
+        progress: optional callable progress(member, processed, total) invoked
+                  after every chunk, with sizes in uncompressed bytes
+        timings: optional odt2epub.timings.Timings collecting the stage times
+        backend: 'sax' for xml.sax, 'expat' to dispatch straight from
+                 xml.parsers.expat, both build the same Document
+        imagesizes: optional odt2epub.cache.ImageSizeCache for the sizes of
+                    the embedded images
+        '''
+        if backend not in BACKENDS:
+            raise Exception(f"Unhandled parser backend '{backend}'")
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.timings = timings or NULL_TIMINGS
+        self.backend = backend
+        self.imagesizes = imagesizes
+        self.diagnostics = None
 
     def parse(self, txtfilename, verbose=0):
         if verbose > 0:
             print(_gt('Parsing: %s') % txtfilename)
 
         document = Document(txtfilename)
+        self.diagnostics = Diagnostics(verbose)
 
         with zipfile.ZipFile(txtfilename) as odtfile:
 
-            ostr = odtfile.read('styles.xml')
-            parse(BytesIO(ostr), StyleHandler(txtfilename, document.styles, False))
+            self._parse_member(odtfile, 'styles.xml', 'style_parse',
+                               StyleHandler(txtfilename, document, False))
+
+            # Automatic styles and body content in a single traversal
+            self._parse_member(odtfile, 'content.xml', 'content_parse',
+                               StyleHandler(txtfilename, document, True),
+                               ContentHandler(txtfilename, document, self.diagnostics))
+
+            self._measure_images(odtfile, document.images.values(), {})
+
+        self.timings.count('styles', len(document.styles))
+        self.timings.count('paragraphs', len(document.paragraps))
+        self.timings.count('notes', len(document.notes))
+        self.timings.count('images', len(document.images))
+
+        self.diagnostics.print_summary(txtfilename)
 
-            ostr = odtfile.read('content.xml')
-            parse(BytesIO(ostr), StyleHandler(txtfilename, document.styles, True))
-            parse(BytesIO(ostr), ContentHandler(txtfilename, document))
+        return document
+
+    def parse_lazy(self, odtfilename, verbose=0):
+        '''Parse the styles now and the body while document.paragraps is iterated.
+
+        Return a LazyDocument: time to the first block and peak memory do not
+        depend on the size of the document, as long as the blocks are consumed
+        as they come (HTMLGenerator.iter_pages does, rendering chapters in
+        parallel or incrementally still collects them all first).
+        '''
+        if verbose > 0:
+            print(_gt('Parsing: %s') % odtfilename)
+
+        document = LazyDocument(odtfilename)
+        self.diagnostics = Diagnostics(verbose)
+
+        odtfile = zipfile.ZipFile(odtfilename)
+        try:
+            self._parse_member(odtfile, 'styles.xml', 'style_parse',
+                               StyleHandler(odtfilename, document, False))
+
+            body = _BodyStart()
+            content = ContentHandler(odtfilename, document, self.diagnostics)
+            document.paragraps.block_open = content.in_open_block
+            source = self._iter_body(odtfile, document,
+                                     StyleHandler(odtfilename, document, True),
+                                     content,
+                                     body)
+            # Automatic styles precede the body, parse them eagerly
+            for __ in source:
+                if body.started:
+                    break
+        except Exception:
+            odtfile.close()
+            raise
+
+        document.paragraps.source = source
+        self.timings.count('styles', len(document.styles))
 
         return document
+
+    def _iter_body(self, odtfile, document, *handlers):
+        notes = 0
+        images = document.images
+        measured = 0
+        contents = {}
+        try:
+            for __ in self._feed_member(odtfile, 'content.xml', 'content_parse', *handlers):
+                # Only the notes of the blocks not yet consumed matter
+                notes += len(document.notes)
+                document.notes.clear()
+                # The images found in this chunk, before their blocks are handed out
+                self._measure_images(odtfile, islice(images.values(), measured, None), contents)
+                measured = len(images)
+                yield
+        finally:
+            odtfile.close()
+
+        self.timings.count('paragraphs', document.paragraps.count)
+        self.timings.count('notes', notes)
+        self.timings.count('images', len(images))
+
+        self.diagnostics.print_summary(document.odtfilename)
+
+    def _measure_images(self, odtfile, images, contents):
+        '''Check the images are in the odt and read their size, streaming the member.
+
+        contents maps (CRC, size) to the distinct images measured so far: an
+        image with the same bytes as one of them takes its name, so that the
+        epub stores it once.
+        '''
+        with self.timings.stage('imagesize'):
+            for image in images:
+                try:
+                    info = odtfile.getinfo(image.href)
+                except KeyError:
+                    self.diagnostics.report(MISSING_IMAGE, '%s', image.href)
+                    continue
+                if image.media_type not in EPUB_IMAGE_TYPES:
+                    self.diagnostics.report(UNSUPPORTED_IMAGE, '%s (%s)', image.href, image.media_type)
+                    continue
+
+                candidates = contents.setdefault((info.CRC, info.file_size), [])
+                duplicate = next((other for other in candidates
+                                  if _same_member(odtfile, other.href, image.href)), None)
+                if duplicate:
+                    image.name = duplicate.name
+                    image.media_type = duplicate.media_type
+                    image.width, image.height = duplicate.width, duplicate.height
+                    image.embedded = True
+                    self.timings.count('duplicate_images')
+                    continue
+                candidates.append(image)
+
+                try:
+                    with odtfile.open(info) as stream:
+                        if self.imagesizes:
+                            # The zip directory identifies the content, a hit reads
+                            # nothing (CRC-32 is no digest, see ImageSizeCache)
+                            image.width, image.height = self.imagesizes.get(
+                                stream, f'{info.CRC:08x}:{info.file_size}:{info.compress_size}')
+                        else:
+                            image.width, image.height = imagesize.get(stream)
+                except ValueError:
+                    # Still embedded, just without its size
+                    pass
+                image.embedded = True
+
+    def _parse_member(self, odtfile, member, stage, *handlers):
+        '''Stream a zip member into the parser without reading it whole'''
+        for __ in self._feed_member(odtfile, member, stage, *handlers):
+            pass
+
+    def _feed_member(self, odtfile, member, stage, *handlers):
+        '''Feed a zip member to the parser, yield after every chunk'''
+        timings = self.timings
+        total = odtfile.getinfo(member).file_size
+        processed = 0
+
+        if self.backend == 'expat':
+            parser = ExpatReader(*handlers)
+        else:
+            parser = make_parser()
+            parser.setContentHandler(DispatchHandler(*handlers) if len(handlers) > 1 else handlers[0])
+
+        with odtfile.open(member) as stream:
+            while True:
+                timings.start('zip_read')
+                chunk = stream.read(self.chunk_size)
+                timings.stop('zip_read')
+                if not chunk:
+                    break
+                timings.start(stage)
+                parser.feed(chunk)
+                timings.stop(stage)
+                processed += len(chunk)
+                if self.progress:
+                    self.progress(member, processed, total)
+                yield
+        with timings.stage(stage):
+            parser.close()
+
+        timings.count(f'{member}_bytes', processed)
+        yield
+
+
+def _same_member(odtfile, name, othername):
+    '''Compare two zip members, they have the same CRC and size already'''
+    with odtfile.open(name) as stream, odtfile.open(othername) as otherstream:
+        while True:
+            chunk = stream.read(DEFAULT_CHUNK_SIZE)
+            if chunk != otherstream.read(DEFAULT_CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
+
+
+class _BodyStart(xml.sax.handler.ContentHandler):
+    '''Notice the start of office:body, i.e. the end of the automatic styles'''
+
+    def __init__(self):
+        super().__init__()
+        self.started = False
+
+    def startElement(self, name, attrs):
+        handler = self.START_HANDLERS.get(name)
+        if handler:
+            handler(self, attrs)
+
+    def _start_body(self, attrs):
+        self.started = True
+
+    START_HANDLERS = {'office:body': _start_body}
+    END_HANDLERS = {}
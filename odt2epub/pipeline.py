@@ -0,0 +1,111 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+import queue
+import threading
+
+
+# Batches waiting in a stage queue before its producer blocks
+DEFAULT_QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+class _Failure:
+
+    __slots__ = ('exception',)
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class ThreadedIterator:
+    '''Iterate iterable in a worker thread, handing its items over through a bounded queue.
+
+    Items travel in batches of batch_size. The worker blocks while maxsize
+    batches are waiting (backpressure). An exception raised by iterable is
+    raised again by the consumer, once the items produced before it are
+    consumed. close(), also called when leaving a with block, stops the
+    worker, closes iterable and waits for the worker to end.
+    '''
+
+    def __init__(self, iterable, maxsize=DEFAULT_QUEUE_SIZE, batch_size=1, name=None):
+        self._queue = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        # Current batch, reversed to pop() the items in order
+        self._batch = []
+        self._finished = False
+        self._thread = threading.Thread(target=self._produce, args=(iterable, batch_size), name=name, daemon=True)
+        self._thread.start()
+
+    def _produce(self, iterable, batch_size):
+        try:
+            batch = []
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if self._stop.is_set():
+                        return
+                    self._queue.put(batch)
+                    batch = []
+            if batch and not self._stop.is_set():
+                self._queue.put(batch)
+        except Exception as e:  # pylint: disable=broad-except
+            self._queue.put(_Failure(e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            self._queue.put(_DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            if self._batch:
+                return self._batch.pop()
+            if self._finished:
+                raise StopIteration
+
+            batch = self._queue.get()
+            if batch is _DONE:
+                self._thread.join()
+                self._finished = True
+            elif isinstance(batch, _Failure):
+                self.close()
+                raise batch.exception
+            else:
+                batch.reverse()
+                self._batch = batch
+
+    def close(self):
+        self._stop.set()
+        self._finished = True
+        self._batch = []
+        # Unblock the worker until it ends
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                self._thread.join(0.01)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -19,20 +19,51 @@ Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
 from xml.sax.handler import ContentHandler
 
 
+# Attributes identifying a style, kept out of the properties so that styles
+# with the same properties can share one dict (see StyleHandler._intern)
+IDENTITY_ATTRIBUTES = ('style:name', 'style:parent-style-name')
+
+
 class Style:
 
+    __slots__ = ('name', '_parent', 'automatic', 'properties', 'has_local_properties_flag',
+                 '_version', '_resolved', '_resolved_generation', '_resolved_version', '_resolved_parent')
+
+    # Bumped whenever any style changes: while it is unchanged every resolved
+    # table is current without walking the parent chain
+    _generation = 0
+
     def __init__(self, attrs, parent, automatic):
         self.name = attrs['style:name']
-        self.parent = parent
+        self._parent = parent
         self.automatic = automatic
 
         self.properties = {}
         self.has_local_properties_flag = False
-        self.set_properties(attrs)
+        # Bumped when this style's own properties or parent change
+        self._version = 0
+        self._resolved = None
+        self._resolved_generation = -1
+        self._resolved_version = -1
+        # Resolved table of the parent the table was computed from
+        self._resolved_parent = None
+        self.set_properties({key: value for key, value in attrs.items() if key not in IDENTITY_ATTRIBUTES})
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = parent
+        self._version += 1
+        Style._generation += 1
 
     def set_properties(self, properties):
-        for key, value in properties.items():
-            self.properties[key] = value
+        # Copy on write, self.properties may be shared with other styles
+        self.properties = {**self.properties, **properties}
+        self._version += 1
+        Style._generation += 1
         # if 'fo:font-style' in properties.keys() and properties['fo:font-style'] == 'italic':
         #     print(properties['fo:font-style'])
         #     self.is_italic = True
@@ -46,38 +77,63 @@ class Style:
         #     if self.align == 'end':
         #         self.align = 'right'
 
+    def _get_resolved(self):
+        '''Return the flattened table of properties resolved along the parent chain'''
+        # Read before resolving: a change made meanwhile invalidates the table
+        generation = Style._generation
+        if self._resolved_generation == generation:
+            return self._resolved
+
+        version = self._version
+        parent_resolved = self._parent._get_resolved() if self._parent else None
+        if self._resolved_version == version and self._resolved_parent is parent_resolved:
+            # Some other style changed, not this one nor its ancestors
+            self._resolved_generation = generation
+            return self._resolved
+
+        if parent_resolved:
+            resolved = dict(parent_resolved)
+        else:
+            resolved = {'display-name': None, 'font-style': None, 'font-weight': None, 'alignment': None}
+
+        if 'style:display-name' in self.properties:
+            resolved['display-name'] = self.properties['style:display-name']
+        elif not (self.automatic and self._parent):
+            resolved['display-name'] = self.name
+
+        for key, prop in (('font-style', 'fo:font-style'),
+                          ('font-weight', 'fo:font-weight'),
+                          ('alignment', 'fo:text-align')):
+            if prop in self.properties:
+                resolved[key] = self.properties[prop]
+        resolved['alignment'] = _css_alignment(resolved['alignment'])
+
+        self._resolved = resolved
+        self._resolved_generation = generation
+        self._resolved_version = version
+        self._resolved_parent = parent_resolved
+        return resolved
+
     def has_local_properties(self):
         return self.has_local_properties_flag
 
     def get_display_name(self, local=False):
-        if 'style:display-name' in self.properties:
-            return self.properties['style:display-name']
-        else:
-            if self.automatic and self.parent and not local:
-                return self.parent.get_display_name()
-            else:
-                return self.name
+        if local:
+            return self.properties.get('style:display-name', self.name)
+        return self._get_resolved()['display-name']
 
     def get_font_style(self, local=False):
-        if 'fo:font-style' in self.properties:
-            return self.properties['fo:font-style']
-        else:
-            if self.parent and not local:
-                return self.parent.get_font_style()
-            else:
-                return None
+        if local:
+            return self.properties.get('fo:font-style')
+        return self._get_resolved()['font-style']
 
     def is_italic(self, local=False):
         return self.get_font_style(local) == 'italic'
 
     def get_font_weight(self, local=False):
-        if 'fo:font-weight' in self.properties:
-            return self.properties['fo:font-weight']
-        else:
-            if self.parent and not local:
-                return self.parent.get_font_weight()
-            else:
-                return None
+        if local:
+            return self.properties.get('fo:font-weight')
+        return self._get_resolved()['font-weight']
 
     def is_bold(self, local=False):
         return self.get_font_weight(local) == 'bold'
@@ -86,19 +142,9 @@ class Style:
     #     return self.properties['style:default-outline-level']
 
     def get_alignment(self, local=False):
-        if 'fo:text-align' in self.properties:
-            alignment = self.properties['fo:text-align']
-            if alignment == 'start':
-                return 'left'
-            elif alignment == 'end':
-                return 'right'
-            else:
-                return alignment
-        else:
-            if self.parent and not local:
-                return self.parent.get_alignment()
-            else:
-                return None
+        if local:
+            return _css_alignment(self.properties.get('fo:text-align'))
+        return self._get_resolved()['alignment']
 
     def has_pagebreak_before(self):
         try:
@@ -124,45 +170,95 @@ class Style:
         return properties
 
 
+def _css_alignment(alignment):
+    if alignment == 'start':
+        return 'left'
+    elif alignment == 'end':
+        return 'right'
+    else:
+        return alignment
+
+
 class StyleHandler(ContentHandler):
 
-    def __init__(self, odtfilename, styles, automatic):
+    def __init__(self, odtfilename, document, automatic):
         super().__init__()
         self.odtfilename = odtfilename
-        self.styles = styles
+        self.document = document
+        self.styles = document.styles
         self.automatic = automatic
 
         self.current_style = None
+        self.unresolved_parents = []
+        # Identical properties dicts, shared between styles
+        self.properties_pool = {}
 
     def startElement(self, name, attrs):
         # print('-' * 20)
         # print(name, attrs.getNames())
         # print(name)
 
-        if name == 'style:style':
-            assert (self.current_style is None), 'Unexpected nested <style:style>'
-            assert (self.styles.get(attrs['style:name']) is None), 'Unexpected duplicated style name %s.' % attrs['style:name']
-
-            parent = self.styles.get(attrs.get('style:parent-style-name'))
-            style = Style(attrs, parent, self.automatic)
-
-            # if style.name == 'P2':
-            #     print(attrs.get('style:parent-style-name'))
-
-            self.current_style = style
-            self.styles[style.name] = self.current_style
-        elif name in ('style:text-properties', 'style:paragraph-properties'):
-            if self.current_style:
-                self.current_style.set_properties(attrs)
-        elif name == 'text:list-style':
-            style = Style(attrs, None, self.automatic)
-            self.current_style = style
-            self.styles[style.name] = self.current_style
-        elif name == 'text:list-level-style-number':
-            self.current_style.set_properties({'list-style':'number'})
-        elif name == 'text:list-level-style-bullet':
-            self.current_style.set_properties({'list-style':'bullet'})
+        handler = self.START_HANDLERS.get(name)
+        if handler:
+            handler(self, attrs)
 
     def endElement(self, name):
-        if name == 'style:style':
-            self.current_style = None
+        handler = self.END_HANDLERS.get(name)
+        if handler:
+            handler(self)
+
+    def _start_style(self, attrs):
+        assert (self.current_style is None), 'Unexpected nested <style:style>'
+        assert (self.styles.get(attrs['style:name']) is None), 'Unexpected duplicated style name %s.' % attrs['style:name']
+
+        parent_name = attrs.get('style:parent-style-name')
+        parent = self.styles.get(parent_name)
+        style = Style(attrs, parent, self.automatic)
+        if parent_name and parent is None:
+            # Parent defined later in the document, resolved in endDocument
+            self.unresolved_parents.append((style, parent_name))
+
+        # if style.name == 'P2':
+        #     print(attrs.get('style:parent-style-name'))
+
+        self.current_style = style
+        self.document.add_style(style)
+
+    def _start_properties(self, attrs):
+        if self.current_style:
+            self.current_style.set_properties(attrs)
+
+    def _start_list_style(self, attrs):
+        style = Style(attrs, None, self.automatic)
+        self.current_style = style
+        self.document.add_style(style)
+
+    def _start_list_level_style_number(self, attrs):
+        self.current_style.set_properties({'list-style':'number'})
+
+    def _start_list_level_style_bullet(self, attrs):
+        self.current_style.set_properties({'list-style':'bullet'})
+
+    def _end_style(self):
+        if self.current_style:
+            self._intern(self.current_style)
+        self.current_style = None
+
+    def _intern(self, style):
+        key = frozenset(style.properties.items())
+        style.properties = self.properties_pool.setdefault(key, style.properties)
+
+    def endDocument(self):
+        for style, parent_name in self.unresolved_parents:
+            style.parent = self.styles.get(parent_name)
+        self.unresolved_parents.clear()
+
+    START_HANDLERS = {'style:style': _start_style,
+                      'style:text-properties': _start_properties,
+                      'style:paragraph-properties': _start_properties,
+                      'text:list-style': _start_list_style,
+                      'text:list-level-style-number': _start_list_level_style_number,
+                      'text:list-level-style-bullet': _start_list_level_style_bullet}
+
+    END_HANDLERS = {'style:style': _end_style,
+                    'text:list-style': _end_style}
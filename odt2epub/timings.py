@@ -0,0 +1,92 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+from contextlib import contextmanager
+import json
+import time
+
+
+class Timings:
+    '''Wall and CPU time of the conversion stages, plus element counts.
+
+    Stages can be entered several times, their times add up. callback, if
+    given, is called as callback(stage, wall, cpu) every time a stage ends.
+    CPU time is the one of the current process, it does not include the
+    worker processes used for parallel rendering.
+    '''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = {}
+        self.counts = {}
+        self._started = {}
+
+    def start(self, stage):
+        self._started[stage] = (time.perf_counter(), time.process_time())
+
+    def stop(self, stage):
+        wall, cpu = self._started.pop(stage)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+
+        totals = self.stages.get(stage)
+        if totals is None:
+            totals = self.stages[stage] = {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+        totals['wall'] += wall
+        totals['cpu'] += cpu
+        totals['calls'] += 1
+
+        if self.callback:
+            self.callback(stage, wall, cpu)
+
+    @contextmanager
+    def stage(self, stage):
+        self.start(stage)
+        try:
+            yield
+        finally:
+            self.stop(stage)
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def as_dict(self):
+        return {'stages': self.stages, 'counts': self.counts}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+class _NullTimings(Timings):
+    '''Default when no instrumentation is requested, records nothing'''
+
+    def start(self, stage):
+        pass
+
+    def stop(self, stage):
+        pass
+
+    @contextmanager
+    def stage(self, stage):
+        yield
+
+    def count(self, name, value=1):
+        pass
+
+
+NULL_TIMINGS = _NullTimings()
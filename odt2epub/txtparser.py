@@ -21,23 +21,32 @@ from odt2epub import _gt
 from odt2epub.document import Document
 from odt2epub.contenthandler import Paragraph
 from odt2epub.stylehandler import Style
+from odt2epub.timings import NULL_TIMINGS
 
 
 class TxtParser:
 
-    def __init__(self):
-        pass
+    def __init__(self, timings=None):
+        self.timings = timings or NULL_TIMINGS
 
     def parse(self, txtfilename, verbose=0):
         if verbose > 0:
             print(_gt('Parsing: %s') % txtfilename)
 
+        with self.timings.stage('txt_parse'):
+            document = self._parse(txtfilename)
+
+        self.timings.count('paragraphs', len(document.paragraps))
+
+        return document
+
+    def _parse(self, txtfilename):
         attrs = {}
         attrs['style:name'] = 'Text body'
         txtstyle = Style(attrs, None, False)
 
         document = Document(txtfilename)
-        document.styles[txtstyle.name] = txtstyle
+        document.add_style(txtstyle)
 
         paragraph = Paragraph(txtstyle, None)
 
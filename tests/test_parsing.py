@@ -0,0 +1,84 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+import os
+import tempfile
+import unittest
+
+from benchmarks import corpus
+from odt2epub.odtparser import OdtParser
+from odt2epub.generator.htmlgenerator import HTMLGenerator
+
+# Small chunks split elements and text runs across feeds
+CHUNK_SIZES = (7, 1000, 64 * 1024)
+
+
+def render(document):
+    '''Pages, stylesheet and TOC of the epub chapters of document'''
+    pages, stylesheet, toc = HTMLGenerator(document, flat_html=False).get_html('../Styles/stylesheet.css')
+    return pages, stylesheet, _toc(toc)
+
+
+def _toc(element):
+    return (element.level, element.pagename, element.hid, element.label, [_toc(child) for child in element.children])
+
+
+class ParsingTest(unittest.TestCase):
+    '''The parsing backends and modes render the synthetic corpus odt identically'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.TemporaryDirectory()
+        cls.odtfilename = os.path.join(cls.workdir.name, 'corpus.odt')
+        corpus.make_odt(cls.odtfilename, 1000)
+        cls.expected = render(OdtParser().parse(cls.odtfilename))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.workdir.cleanup()
+
+    def test_corpus_rendered(self):
+        pages, __, toc = self.expected
+        self.assertGreater(len(pages), 10)
+        self.assertTrue(toc[4])
+        html = ''.join(page for __, __, page in pages)
+        for fragment in ('<img ', '<li>', 'class="quotations"', 'href="#'):
+            self.assertIn(fragment, html)
+
+    def test_expat_backend(self):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                document = OdtParser(chunk_size=chunk_size, backend='expat').parse(self.odtfilename)
+                self.assertEqual(render(document), self.expected)
+
+    def test_sax_chunk_sizes(self):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                document = OdtParser(chunk_size=chunk_size).parse(self.odtfilename)
+                self.assertEqual(render(document), self.expected)
+
+    def test_lazy(self):
+        for backend in ('sax', 'expat'):
+            for chunk_size in CHUNK_SIZES:
+                with self.subTest(backend=backend, chunk_size=chunk_size):
+                    document = OdtParser(chunk_size=chunk_size, backend=backend).parse_lazy(self.odtfilename)
+                    self.assertEqual(render(document), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+'''
+This file is part of odt2epub.
+
+odt2epub is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+odt2epub is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with odt2epub.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2015 Alessio Piccoli <alepic@geckoblu.net>
+'''
+import io
+import random
+import unittest
+from unittest import mock
+import zipfile
+
+from odt2epub.generator import ziputils
+from odt2epub.generator.ziputils import copy_raw_entry, deflate, write_deflated_entry
+
+ENTRIES = {'text.xhtml': b'<p>lorem ipsum</p>\n' * 5000,
+           'random.bin': random.Random(0).getrandbits(8 * 200 * 1024).to_bytes(200 * 1024, 'little'),
+           'empty.txt': b''}
+
+
+class ZipUtilsTest(unittest.TestCase):
+    '''Entries written by ziputils, through the zipfile internals and through
+    the writestr() fallback used when they are missing'''
+
+    def _source(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zfile:
+            zfile.writestr('text.xhtml', ENTRIES['text.xhtml'], zipfile.ZIP_DEFLATED)
+            zfile.writestr('random.bin', ENTRIES['random.bin'], zipfile.ZIP_STORED)
+            zfile.writestr('empty.txt', ENTRIES['empty.txt'], zipfile.ZIP_DEFLATED)
+        return buffer
+
+    def _check(self, buffer, expected):
+        with zipfile.ZipFile(buffer) as zfile:
+            self.assertIsNone(zfile.testzip())
+            self.assertEqual(zfile.namelist(), list(expected))
+            for name, (data, compress_type) in expected.items():
+                self.assertEqual(zfile.read(name), data)
+                self.assertEqual(zfile.getinfo(name).compress_type, compress_type)
+
+    def _copy_and_write(self):
+        target = io.BytesIO()
+        with zipfile.ZipFile(self._source()) as source, zipfile.ZipFile(target, 'w') as zfile:
+            zfile.writestr('mimetype', b'application/epub+zip')
+            for name in ENTRIES:
+                copy_raw_entry(source, zfile, name, f'copy/{name}')
+            copy_raw_entry(source, zfile, 'text.xhtml')
+            for name, data in ENTRIES.items():
+                write_deflated_entry(zfile, f'deflated/{name}', data, deflate(data, 6))
+            zfile.writestr('last.txt', b'written after the raw entries')
+
+        expected = {'mimetype': (b'application/epub+zip', zipfile.ZIP_STORED)}
+        for name, compress_type in (('text.xhtml', zipfile.ZIP_DEFLATED), ('random.bin', zipfile.ZIP_STORED),
+                                    ('empty.txt', zipfile.ZIP_DEFLATED)):
+            expected[f'copy/{name}'] = (ENTRIES[name], compress_type)
+        expected['text.xhtml'] = (ENTRIES['text.xhtml'], zipfile.ZIP_DEFLATED)
+        for name, data in ENTRIES.items():
+            expected[f'deflated/{name}'] = (data, zipfile.ZIP_DEFLATED)
+        expected['last.txt'] = (b'written after the raw entries', zipfile.ZIP_STORED)
+        self._check(target, expected)
+
+    def test_internals_available(self):
+        with zipfile.ZipFile(io.BytesIO(), 'w') as zfile:
+            self.assertTrue(ziputils._has_internals(zfile))
+
+    def test_raw_entries(self):
+        self._copy_and_write()
+
+    def test_writestr_fallback(self):
+        with mock.patch.object(ziputils, '_has_internals', return_value=False), \
+                mock.patch.object(ziputils, '_write_raw_entry', side_effect=AssertionError('internals used')):
+            self._copy_and_write()
+
+    def test_bad_source(self):
+        source = self._source()
+        with zipfile.ZipFile(source) as zfile:
+            offset = zfile.getinfo('random.bin').header_offset
+        source.getbuffer()[offset] ^= 0xFF
+        with zipfile.ZipFile(source) as zfile, zipfile.ZipFile(io.BytesIO(), 'w') as target:
+            with self.assertRaises(zipfile.BadZipFile):
+                copy_raw_entry(zfile, target, 'random.bin')
+
+
+if __name__ == '__main__':
+    unittest.main()